@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""bench_xhighlights.py
+
+    Benchmarks for xhighlights, run outside of HexChat using the stand-in
+    hexchat module in this directory.
+    Results are printed as JSON, so runs from two commits can be compared
+    on the same machine.
+
+    Usage:
+        ./bench_xhighlights.py [BENCHMARK...] [options]
+
+    Options:
+        BENCHMARK              : Names of benchmarks to run (default: all).
+        -c num,--cachesize num : Render cache size for message_filter.
+                                 Default: 0 (disabled)
+        -C num,--custom num    : Custom pattern density (0-1). Default: 0.05
+        -L num,--lines num     : Number of synthetic lines. Default: 5000
+        -l,--list              : List benchmark names and exit.
+        -N num,--nick num      : Nick mention density (0-1). Default: 0.05
+        -n num,--nicks num     : Number of nicks in the channel.
+                                 Default: 3000
+        -o file,--out file     : Write JSON results to a file too.
+        -p num,--patterns num  : Number of custom patterns for the line
+                                 benchmarks. Default: 50
+        -r num,--rules num     : Number of custom pattern rules for the
+                                 load benchmark. Default: 5000
+        -s num,--seed num      : Random seed for synthetic lines.
+                                 Default: 0
+        -U num,--url num       : URL/email density (0-1). Default: 0.05
+    -Christopher Welborn
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import logging
+import os
+import pickle
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+
+BENCHDIR = os.path.abspath(os.path.dirname(__file__))
+REPODIR = os.path.dirname(BENCHDIR)
+# The stand-in hexchat module must be found first.
+sys.path.insert(0, REPODIR)
+sys.path.insert(0, BENCHDIR)
+
+# Benchmark functions by name, see @benchmark.
+BENCHMARKS = {}
+# Filler words for synthetic lines.
+WORDS = (
+    'the', 'a', 'and', 'to', 'of', 'is', 'it', 'that', 'for', 'you', 'was',
+    'with', 'on', 'this', 'just', 'have', 'but', 'not', 'build', 'merge',
+    'conflict', 'failed', 'works', 'here', 'there', 'yeah', 'lol', 'hmm',
+    'what', 'why', 'because', 'python', 'release', 'patch', 'ok.', 'thanks!',
+)
+URLS = (
+    'http://example.com/some/path?q=1', 'https://docs.python.org/3/',
+    'www.example.org', 'irc.libera.chat', 'ftp://files.example.net/x.tgz',
+    'someone@example.com', 'example.info', 'https://github.com/a/b/pull/1',
+    'example.io', 'pkg.foo.dev/docs',
+)
+
+
+def benchmark(func):
+    """ Decorator, registers a benchmark function by name.
+        Benchmark functions take the parsed args, and return a dict of
+        results.
+    """
+    BENCHMARKS[func.__name__.replace('bench_', '')] = func
+    return func
+
+
+def import_plugin(name, workdir):
+    """ Import a plugin module quietly, from workdir (where it may create
+        files).
+    """
+    oldcwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            module = importlib.import_module(name)
+    finally:
+        os.chdir(oldcwd)
+    return module
+
+
+def import_xhighlights(workdir):
+    """ Import xhighlights quietly. The log file is created in workdir. """
+    return import_plugin('xhighlights', workdir)
+
+
+def generate_rules(count):
+    """ Generate plain custom pattern rules, like the ticket/PEP/CVE
+        linkifiers people use.
+    """
+    styles = ('bold,darkblue', 'red', 'u,green', 'purple')
+    rules = []
+    for i in range(count):
+        kind = i % 4
+        label = 'T{}X'.format(i)
+        if kind == 0:
+            pattern = r'^{}-(\d+)'.format(label)
+            template = 'http://tickets.example.com/{}/{{}}'.format(i)
+        elif kind == 1:
+            pattern = r'^(?P<lbl>{})(?P<num>\d{{1,5}})'.format(label)
+            template = 'http://example.com/{}/{{num}}'.format(i)
+        elif kind == 2:
+            pattern = r'^[{}{}]{}:(\w+)'.format(
+                label[0],
+                label[0].lower(),
+                label[1:]
+            )
+            template = '{}'
+        else:
+            pattern = r'^{}$'.format(label)
+            template = '{}'
+        rules.append({
+            'pattern': pattern,
+            'style': styles[i % len(styles)],
+            'template': template,
+        })
+    return rules
+
+
+def generate_lines(args, nicks, rules):
+    """ Generate synthetic channel lines, with a density of urls, nicks,
+        and custom pattern triggers set by args.
+    """
+    rand = random.Random(args.seed)
+    triggers = [custom_trigger(rand, i) for i in range(len(rules))] or ['x']
+    lines = []
+    for _ in range(args.lines):
+        words = []
+        for _ in range(rand.randint(4, 20)):
+            roll = rand.random()
+            if roll < args.url:
+                words.append(rand.choice(URLS))
+            elif roll < (args.url + args.nick):
+                nick = rand.choice(nicks)
+                words.append(rand.choice((nick, nick + ':', nick + ',')))
+            elif roll < (args.url + args.nick + args.custom):
+                words.append(rand.choice(triggers))
+            else:
+                words.append(rand.choice(WORDS))
+        lines.append(' '.join(words))
+    return lines
+
+
+def generate_nicks(count, seed=0):
+    """ Generate some random nicks. """
+    rand = random.Random(seed)
+    chars = 'abcdefghijklmnopqrstuvwxyz'
+    nicks = set()
+    while len(nicks) < count:
+        nick = ''.join(rand.choice(chars) for _ in range(rand.randint(3, 9)))
+        nicks.add(rand.choice((nick, nick, nick + '_', nick.title())))
+    return sorted(nicks)
+
+
+def custom_trigger(rand, index):
+    """ Return a word that matches rule number `index` from
+        generate_rules().
+    """
+    label = 'T{}X'.format(index)
+    kind = index % 4
+    if kind == 0:
+        return '{}-{}'.format(label, rand.randint(1, 9999))
+    elif kind == 1:
+        return '{}{}'.format(label, rand.randint(1, 9999))
+    elif kind == 2:
+        return '{}:thing'.format(label.lower())
+    return label
+
+
+def latency_stats(times, count=None):
+    """ Summarize a list of per-call times (in seconds).
+        Percentiles are in microseconds, rate is calls per second.
+    """
+    times = sorted(times)
+    total = sum(times)
+    count = len(times) if count is None else count
+
+    def percentile(pct):
+        index = min(len(times) - 1, int(round((pct / 100) * len(times))))
+        return times[index] * 1000000
+
+    return {
+        'calls': count,
+        'total_seconds': total,
+        'per_second': (count / total) if total else 0,
+        'mean_us': (total / max(count, 1)) * 1000000,
+        'p50_us': percentile(50),
+        'p90_us': percentile(90),
+        'p99_us': percentile(99),
+        'max_us': times[-1] * 1000000,
+    }
+
+
+def setup_channel(args):
+    """ Import xhighlights, fill the channel with nicks, and load custom
+        patterns. Returns (xhighlights, lines, nicks).
+    """
+    import hexchat
+    workdir = tempfile.mkdtemp(prefix='bench_xhighlights.')
+    xhighlights = import_xhighlights(workdir)
+    nicks = generate_nicks(args.nicks, seed=args.seed)
+    hexchat.users = [hexchat.User(nick) for nick in nicks]
+    rules = generate_rules(args.patterns)
+    xhighlights.swap_rules(xhighlights.Codes.rules.replace(
+        custom=xhighlights.load_pattern_rules(rules)
+    ))
+    xhighlights.RENDERCACHE.maxsize = args.cachesize
+    # Lines are sent as fast as possible, which would look like a flood.
+    xhighlights.FloodMonitor.threshold = 0
+    xhighlights.RENDERCACHE.clear()
+    xhighlights.NICKS.invalidate(xhighlights.get_context_key())
+    lines = generate_lines(args, nicks, rules)
+    return xhighlights, lines, nicks
+
+
+def time_calls(func, items):
+    """ Call func(item) for each item, returns a list of times. """
+    clock = time.perf_counter
+    times = []
+    for item in items:
+        start = clock()
+        func(item)
+        times.append(clock() - start)
+    return times
+
+
+def timed(func, *args, **kwargs):
+    """ Run a function once, returns (seconds, result). """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+@benchmark
+def bench_load(args):
+    """ Time loading custom pattern rules from the rule file, compared to
+        unpickling the old pickle file, and migrating from it.
+    """
+    workdir = tempfile.mkdtemp(prefix='bench_xhighlights.')
+    xhighlights = import_xhighlights(workdir)
+    rules = generate_rules(args.rules)
+    customfile = os.path.join(workdir, 'xhighlights.json')
+    picklefile = os.path.join(workdir, 'xhighlights.pkl')
+    xhighlights.CUSTOMFILE = customfile
+    xhighlights.PICKLEFILE = picklefile
+
+    # Old format, compiled patterns and stylecodes were pickled.
+    oldpatterns = [
+        {
+            'pattern': re.compile(rule['pattern']),
+            'patterntext': rule['pattern'],
+            'stylecodes': xhighlights.get_stylecodes(rule['style']),
+            'style': rule['style'],
+            'template': rule['template'],
+        }
+        for rule in rules
+    ]
+    with open(picklefile, 'wb') as f:
+        pickle.dump(oldpatterns, f)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Migration writes the new rule file.
+        re.purge()
+        migrate_time, _ = timed(xhighlights.load_user_patterns)
+        re.purge()
+        load_time, _ = timed(xhighlights.load_user_patterns)
+
+    def load_pickle():
+        with open(picklefile, 'rb') as f:
+            return pickle.load(f)
+
+    re.purge()
+    pickle_time, _ = timed(load_pickle)
+    loaded = len(xhighlights.Codes.rules.custom)
+    return {
+        'rules': len(rules),
+        'loaded': loaded,
+        'rule_file_bytes': os.path.getsize(customfile),
+        'pickle_file_bytes': os.path.getsize(picklefile),
+        'migrate_seconds': migrate_time,
+        'load_seconds': load_time,
+        'load_us_per_rule': (load_time / max(loaded, 1)) * 1000000,
+        'pickle_load_seconds': pickle_time,
+    }
+
+
+@benchmark
+def bench_highlight_custom(args):
+    """ Time highlight_custom() for words that match a custom pattern. """
+    xhighlights, lines, _ = setup_channel(args)
+    matches = []
+    for line in lines:
+        for word in line.split(' '):
+            patterninfo, rematch = xhighlights.Codes.rules.matcher.match(word)
+            if patterninfo is not None:
+                matches.append((word, patterninfo, rematch))
+    if not matches:
+        return {'calls': 0}
+    highlight_custom = xhighlights.highlight_custom
+    return latency_stats(time_calls(
+        lambda m: highlight_custom(*m),
+        matches
+    ))
+
+
+@benchmark
+def bench_highlight_word(args):
+    """ Time highlight_word() for link and nick words. """
+    xhighlights, lines, _ = setup_channel(args)
+    words = [w for line in lines for w in line.split(' ')]
+    highlight_word = xhighlights.highlight_word
+    styles = ('link', 'nick')
+    return latency_stats(time_calls(
+        lambda iw: highlight_word(iw[1], styles[iw[0] % 2], ownmsg=iw[0] % 3),
+        list(enumerate(words))
+    ))
+
+
+@benchmark
+def bench_link_re(args):
+    """ Time finding all links in a line with find_links(), and with the
+        old link_re that only knew a few extensions instead of TLDS.
+        Lines with only filler words and dotted non-links are timed too,
+        they are where the TLD check runs the most.
+    """
+    xhighlights, lines, _ = setup_channel(args)
+    url_pre = xhighlights.url_pre
+    url_ext = ('org', 'net', 'com', 'edu', 'html', 'info', 'name')
+    wordstart = r'(?<![^ ])'
+    old_link_re = re.compile(
+        '(?P<link>{}|{}{})|(?P<email>{})'.format(
+            r'{}(?:{})[^ ][\w\-]+'.format(wordstart, '|'.join(url_pre)),
+            r'(?<![\w\-])[\w\-]+',
+            r'\.(?:{})(?![\w\.])'.format('|'.join(url_ext)),
+            r'{}[^ ][^ @]*@[^ ][^ \.]*\.[^ ]'.format(wordstart),
+        )
+    )
+    old_finditer = old_link_re.finditer
+    dotted = [
+        '{} file.txt v1.2.3 e.g. 3.14 ok. {}'.format(line[:40], line[40:])
+        for line in lines
+    ]
+    return {
+        'find_links': latency_stats(
+            time_calls(xhighlights.find_links, lines)
+        ),
+        'old_link_re': latency_stats(
+            time_calls(lambda line: list(old_finditer(line)), lines)
+        ),
+        'find_links_dotted': latency_stats(
+            time_calls(xhighlights.find_links, dotted)
+        ),
+        'old_link_re_dotted': latency_stats(
+            time_calls(lambda line: list(old_finditer(line)), dotted)
+        ),
+    }
+
+
+@benchmark
+def bench_logging(args):
+    """ Time message_filter() with debug logging off, and then on.
+        With debug on, records are written to the log file in workdir by
+        the background writer thread.
+    """
+    xhighlights, lines, nicks = setup_channel(args)
+    message_filter = xhighlights.message_filter
+    event = xhighlights.EVENT_PIPELINES['Channel Message']
+    message_filter([nicks[0], 'warming up'], None, event)
+    items = [(nicks[i % len(nicks)], line) for i, line in enumerate(lines)]
+
+    def run():
+        return latency_stats(time_calls(
+            lambda item: message_filter(list(item), None, event),
+            items
+        ))
+
+    results = {}
+    for name, level in (('debug_off', logging.ERROR), ('debug_on', 0)):
+        xhighlights._logger.setlevel(level or logging.DEBUG)
+        # Render cache hits would hide the cost of logging.
+        xhighlights.RENDERCACHE.clear()
+        results[name] = run()
+    xhighlights._logger.setlevel(logging.ERROR)
+    # Wait for queued records to be written.
+    flush_time, _ = timed(xhighlights._logger.stop)
+    results['flush_seconds'] = flush_time
+    results['log_file_bytes'] = os.path.getsize(
+        xhighlights._logger.filehandler.baseFilename
+    )
+    return results
+
+
+@benchmark
+def bench_message_filter(args):
+    """ Time message_filter() for synthetic 'Channel Message' lines. """
+    import hexchat
+    xhighlights, lines, nicks = setup_channel(args)
+    message_filter = xhighlights.message_filter
+    event = xhighlights.EVENT_PIPELINES['Channel Message']
+    # Build the nick index before timing.
+    message_filter([nicks[0], 'warming up'], None, event)
+    emitted = hexchat.emitted
+    skipped = xhighlights.Stats.skipped
+    items = [(nicks[i % len(nicks)], line) for i, line in enumerate(lines)]
+    stats = latency_stats(time_calls(
+        lambda item: message_filter(list(item), None, event),
+        items
+    ))
+    stats['emitted'] = hexchat.emitted - emitted
+    stats['skipped'] = xhighlights.Stats.skipped - skipped
+    return stats
+
+
+@benchmark
+def bench_phrases(args):
+    """ Time tokenize_message() with 1 phrase pattern, and with as many
+        phrase patterns as word patterns (--patterns). Phrases are all
+        found in one pass, so the cost shouldn't grow with the count.
+    """
+    xhighlights, lines, nicks = setup_channel(args)
+    wordpatterns = list(xhighlights.Codes.rules.custom)
+    nickmatcher = xhighlights.NICKS.get(xhighlights.get_context_key())
+    results = {}
+    for count in (1, max(args.patterns, 1)):
+        phrases = [
+            xhighlights.build_patterninfo(
+                re.compile(r'build #{}\d* (?:failed|passed)'.format(i)),
+                'red',
+                '{}',
+                phrase=True
+            )
+            for i in range(count)
+        ]
+        xhighlights.swap_rules(xhighlights.Codes.rules.replace(
+            custom=wordpatterns + phrases
+        ))
+        tokenize = xhighlights.tokenize_message
+        results['phrases_{}'.format(count)] = latency_stats(time_calls(
+            lambda line: tokenize(line, nickmatcher=nickmatcher),
+            ['{} build #{}1 failed'.format(line, i % count)
+             for i, line in enumerate(lines)]
+        ))
+    return results
+
+
+@benchmark
+def bench_remove_mirc_color(args):
+    """ Time remove_mirc_color() for colored nicks and lines, for
+        xhighlights and xtools, and the implementations they replaced.
+        The old xtools version called xchat.strip(), which is a no-op
+        in the stand-in module, so it is a lower bound.
+    """
+    import hexchat
+    xhighlights, lines, nicks = setup_channel(args)
+    xtools = import_plugin(
+        'xtools',
+        tempfile.mkdtemp(prefix='bench_xhighlights.')
+    )
+    colored = [
+        '\x03{:02}{}\x0f'.format(i % 16, nick) for i, nick in enumerate(nicks)
+    ]
+    colored.extend(
+        '\x0304,01{}\x03 \x02{}\x02'.format(line[:20], line[20:])
+        for line in lines
+    )
+    # Nicks are stripped over and over (memoized), lines are not.
+    items = colored + colored[:len(nicks)] * 10
+
+    old_sub = re.compile(
+        re.escape('\x03') + r'(?:(\d{1,2})(?:,(\d{1,2}))?)?'
+    ).sub
+
+    def old_xhighlights(text):
+        return old_sub('', text)
+
+    def old_xtools(text):
+        for badchar in ('\x08<', '\x08', '\x0f'):
+            if badchar in text:
+                text = text.replace(badchar, '')
+        return hexchat.strip(text)
+
+    return {
+        'xhighlights': latency_stats(
+            time_calls(xhighlights.remove_mirc_color, items)
+        ),
+        'xtools': latency_stats(time_calls(xtools.remove_mirc_color, items)),
+        'old_xhighlights': latency_stats(time_calls(old_xhighlights, items)),
+        'old_xtools': latency_stats(time_calls(old_xtools, items)),
+    }
+
+
+def main(argv=None):
+    """ Main entry point, runs benchmarks and prints JSON results. """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for xhighlights, run outside of HexChat.'
+    )
+    parser.add_argument(
+        'benchmarks',
+        nargs='*',
+        metavar='BENCHMARK',
+        help='Names of benchmarks to run (default: all).'
+    )
+    parser.add_argument(
+        '-c', '--cachesize',
+        type=int,
+        default=0,
+        help='Render cache size for message_filter.'
+    )
+    parser.add_argument(
+        '-C', '--custom',
+        type=float,
+        default=0.05,
+        help='Custom pattern density (0-1).'
+    )
+    parser.add_argument(
+        '-L', '--lines',
+        type=int,
+        default=5000,
+        help='Number of synthetic lines.'
+    )
+    parser.add_argument(
+        '-l', '--list',
+        action='store_true',
+        help='List benchmark names and exit.'
+    )
+    parser.add_argument(
+        '-N', '--nick',
+        type=float,
+        default=0.05,
+        help='Nick mention density (0-1).'
+    )
+    parser.add_argument(
+        '-n', '--nicks',
+        type=int,
+        default=3000,
+        help='Number of nicks in the channel.'
+    )
+    parser.add_argument(
+        '-o', '--out',
+        help='Write JSON results to a file too.'
+    )
+    parser.add_argument(
+        '-p', '--patterns',
+        type=int,
+        default=50,
+        help='Number of custom patterns for the line benchmarks.'
+    )
+    parser.add_argument(
+        '-r', '--rules',
+        type=int,
+        default=5000,
+        help='Number of custom pattern rules for the load benchmark.'
+    )
+    parser.add_argument(
+        '-s', '--seed',
+        type=int,
+        default=0,
+        help='Random seed for synthetic lines.'
+    )
+    parser.add_argument(
+        '-U', '--url',
+        type=float,
+        default=0.05,
+        help='URL/email density (0-1).'
+    )
+    args = parser.parse_args(argv)
+    if args.list:
+        for name in sorted(BENCHMARKS):
+            print(name)
+        return 0
+
+    names = args.benchmarks or sorted(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('Unknown benchmarks: {}'.format(', '.join(unknown)))
+
+    settings = {
+        k: v for k, v in vars(args).items()
+        if k not in ('benchmarks', 'list', 'out')
+    }
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': settings,
+        'results': {name: BENCHMARKS[name](args) for name in names},
+    }
+    output = json.dumps(results, indent=4, sort_keys=True)
+    print(output)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write('{}\n'.format(output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
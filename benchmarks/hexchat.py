@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""hexchat.py
+
+    A stand-in for the hexchat module, so plugins can be imported and
+    benchmarked outside of HexChat (see bench_xhighlights.py).
+    Only the parts of the API that the plugins use are here.
+    Hooks are recorded but never called, and prints are discarded.
+    -Christopher Welborn
+"""
+
+EAT_NONE = 0
+EAT_HEXCHAT = 1
+EAT_PLUGIN = 2
+EAT_ALL = 3
+PRI_NORM = 0
+
+# Info for get_info(), benchmarks can change these.
+info = {
+    'channel': '#bench',
+    'network': 'BenchNet',
+    'nick': 'benchuser',
+    'server': 'irc.bench.example',
+}
+# Prefs for get_prefs().
+prefs = {'id': 1}
+# Users for get_list('users').
+users = []
+# Hooks by event/command name: [(func, userdata), ...]
+hooks = {}
+# Number of emit_print() calls.
+emitted = 0
+
+
+class User(object):
+    """ An item from get_list('users'). """
+
+    def __init__(self, nick, host='bench@bench.example'):
+        self.nick = nick
+        self.host = host
+        self.prefix = ''
+
+
+class Context(object):
+    """ A context from get_context(), always the same channel. """
+
+    def command(self, cmd):
+        return None
+
+    def emit_print(self, *args):
+        global emitted
+        emitted += 1
+        return True
+
+    def get_info(self, name):
+        return get_info(name)
+
+    def get_list(self, name):
+        return get_list(name)
+
+    def prnt(self, s):
+        return None
+
+
+def _hook(name, func, userdata):
+    hooks.setdefault(name, []).append((func, userdata))
+    return (name, func)
+
+
+def command(cmd):
+    return None
+
+
+def emit_print(*args):
+    return Context().emit_print(*args)
+
+
+def get_context():
+    return Context()
+
+
+def get_info(name):
+    return info.get(name, None)
+
+
+def get_list(name):
+    if name == 'users':
+        return users
+    return []
+
+
+def get_prefs(name):
+    return prefs.get(name, None)
+
+
+def hook_command(name, func, userdata=None, priority=PRI_NORM, help=None):
+    return _hook(name, func, userdata)
+
+
+def hook_print(name, func, userdata=None, priority=PRI_NORM):
+    return _hook(name, func, userdata)
+
+
+def hook_server(name, func, userdata=None, priority=PRI_NORM):
+    return _hook(name, func, userdata)
+
+
+def hook_timer(timeout, func, userdata=None):
+    return _hook('timer', func, userdata)
+
+
+def hook_unload(func, userdata=None):
+    return _hook('unload', func, userdata)
+
+
+def prnt(s):
+    return None
+
+
+def strip(text, length=-1, flags=3):
+    return text
+
+
+def unhook(handle):
+    name, func = handle
+    hooks[name] = [h for h in hooks.get(name, []) if h[0] is not func]
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+""" Tests for remove_mirc_color() in xhighlights and xtools.
+
+    The plugins are copied to a temporary directory and imported from
+    there (with the stand-in hexchat module from benchmarks/), so any
+    config/log files they create stay out of the repo.
+"""
+
+import contextlib
+import importlib.util
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+REPODIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BENCHDIR = os.path.join(REPODIR, 'benchmarks')
+if BENCHDIR not in sys.path:
+    sys.path.insert(0, BENCHDIR)
+
+PLUGINS = ('xhighlights', 'xtools')
+WORKDIR = tempfile.mkdtemp(prefix='test_mirc_')
+
+
+def import_plugin(name):
+    """ Import a copy of a plugin module quietly, from WORKDIR. """
+    filename = os.path.join(WORKDIR, '{}.py'.format(name))
+    shutil.copy(os.path.join(REPODIR, '{}.py'.format(name)), filename)
+    for datafile in ('xhighlights_tlds.txt', ):
+        datapath = os.path.join(REPODIR, datafile)
+        if os.path.exists(datapath):
+            shutil.copy(datapath, WORKDIR)
+    spec = importlib.util.spec_from_file_location(
+        'test_{}'.format(name),
+        filename
+    )
+    module = importlib.util.module_from_spec(spec)
+    oldcwd = os.getcwd()
+    os.chdir(WORKDIR)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            spec.loader.exec_module(module)
+    finally:
+        os.chdir(oldcwd)
+    return module
+
+
+def tearDownModule():
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+class RemoveMircColorTests(object):
+    """ Shared test cases, subclasses set `plugin`. """
+    plugin = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.module = import_plugin(cls.plugin)
+        cls.strip = staticmethod(cls.module.remove_mirc_color)
+
+    def setUp(self):
+        self.module.mirc_strip_cache.clear()
+
+    def assert_stripped(self, text, expected):
+        self.assertEqual(
+            self.strip(text),
+            expected,
+            msg='Bad strip for: {!r}'.format(text)
+        )
+        # Long text bypasses the cache, make sure it agrees.
+        padding = 'x' * 40
+        self.assertEqual(
+            self.strip(''.join((text, padding))),
+            ''.join((expected, padding)),
+            msg='Bad uncached strip for: {!r}'.format(text)
+        )
+
+    def test_plain(self):
+        self.assert_stripped('', '')
+        self.assert_stripped('plain text', 'plain text')
+
+    def test_color_fore_back(self):
+        self.assert_stripped('\x034test', 'test')
+        self.assert_stripped('\x0304test', 'test')
+        self.assert_stripped('\x034,5test', 'test')
+        self.assert_stripped('\x0312,05test', 'test')
+        self.assert_stripped('a\x03b', 'ab')
+
+    def test_color_comma_without_fore(self):
+        # No foreground means a plain reset, the comma is text.
+        self.assert_stripped('\x03,5test', ',5test')
+
+    def test_color_comma_without_back(self):
+        self.assert_stripped('\x0312,x', ',x')
+        self.assert_stripped('\x0312,', ',')
+
+    def test_color_three_digits(self):
+        # Colors are at most two digits, the rest is text.
+        self.assert_stripped('\x03123', '3')
+        self.assert_stripped('\x03123,456', '3,456')
+        self.assert_stripped('\x0312,345', '5')
+
+    def test_hex_color(self):
+        self.assert_stripped('\x04FF0000test', 'test')
+        self.assert_stripped('\x04ff0000,00ff00test', 'test')
+        self.assert_stripped('\x04FF0000,00Ftest', ',00Ftest')
+        self.assert_stripped('\x04test', 'test')
+
+    def test_hex_color_short(self):
+        # Hex colors are exactly six digits, short ones are text.
+        self.assert_stripped('\x04FFF', 'FFF')
+        self.assert_stripped('\x04ABCDE!', 'ABCDE!')
+
+    def test_hex_color_long(self):
+        self.assert_stripped('\x04ABCDEF01', '01')
+        self.assert_stripped('\x04ABCDEF,1234567', '7')
+
+    def test_hexchat_marker(self):
+        self.assert_stripped('\x08<nick\x08>', 'nick>')
+        self.assert_stripped('\x08nick', 'nick')
+
+    def test_styles(self):
+        self.assert_stripped(
+            '\x02b\x0fo\x11m\x16r\x1di\x1es\x1fu',
+            'bomrisu'
+        )
+
+    def test_cache_short_only(self):
+        cache = self.module.mirc_strip_cache
+        self.strip('\x02short')
+        self.assertEqual(cache, {'\x02short': 'short'})
+        self.strip('\x02{}'.format('x' * 40))
+        self.assertEqual(len(cache), 1)
+
+    def test_cache_eviction(self):
+        cache = {}
+        for i in range(3):
+            self.strip('\x02{}'.format(i), _cache=cache, _cachemax=3)
+        self.assertEqual(len(cache), 3)
+        # Full cache is cleared before the new entry is stored.
+        self.assertEqual(
+            self.strip('\x02new', _cache=cache, _cachemax=3),
+            'new'
+        )
+        self.assertEqual(cache, {'\x02new': 'new'})
+        # Cached results still come back right.
+        self.assertEqual(
+            self.strip('\x02new', _cache=cache, _cachemax=3),
+            'new'
+        )
+
+    def test_cache_eviction_default(self):
+        cache = self.module.mirc_strip_cache
+        cachemax = self.strip.__defaults__[-1]
+        for i in range(cachemax):
+            self.strip('\x02{}'.format(i))
+        self.assertEqual(len(cache), cachemax)
+        self.assertEqual(self.strip('\x03,5'), ',5')
+        self.assertEqual(cache, {'\x03,5': ',5'})
+
+
+class XHighlightsTests(RemoveMircColorTests, unittest.TestCase):
+    plugin = 'xhighlights'
+
+
+class XToolsTests(RemoveMircColorTests, unittest.TestCase):
+    plugin = 'xtools'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,35 @@
     Colors/Styles are customisable.
     -Christopher Welborn
 """
+import cProfile
+import gzip
+import heapq
+import io
+import json
 import logging
-import pickle
+import logging.handlers
 import os
+import pickle
+import pstats
+import queue
 import re
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from itertools import count
+try:
+    # Python 3.11+
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 __module_name__ = 'xhighlights'
 __module_version__ = '1.0.0'
@@ -21,9 +46,16 @@ VERSIONSTR = '{} v. {}'.format(__module_name__, __module_version__)
 
 class logger(object):
 
-    """ Simple file logger, created with mylog = logger('logname').log """
+    """ Simple file logger, created with mylog = logger('logname').log
+        Records are handed to a queue, and written to the file by a
+        background thread, so logging never blocks on file i/o.
+        The file is rotated when it grows past maxbytes, keeping `backups`
+        old segments (filename.1 is the newest), optionally gzipped.
+    """
 
-    def __init__(self, logname, filename=None, level=None, maxbytes=2097152):
+    def __init__(
+            self, logname, filename=None, level=None, maxbytes=2097152,
+            backups=3, compress=False):
         """ Initialize a new logger.
             Arguments:
                 logname  : Name for this logger (shows in logfile)
@@ -32,8 +64,10 @@ class logger(object):
                 filename  : File name to use, defaults to:
                             logname.lower().replace(' ', '-')
                 level     : Logging level, defaults to: logging.DEBUG
-                maxbytes  : Delete old logfile on init if bigger than maxbytes.
-                            Default: 2097152 (~2MB)
+                maxbytes  : Rotate the logfile when it is bigger than
+                            maxbytes. Default: 2097152 (~2MB)
+                backups   : Number of old logfiles to keep. Default: 3
+                compress  : Whether to gzip old logfiles. Default: False
         """
 
         # initialize logger with name
@@ -43,45 +77,126 @@ class logger(object):
             self.filename = filename
         else:
             self.filename = '{}.log'.format(logname.lower().replace(' ', '-'))
-        # Check existing log size if available...
-        if self.rotate_logfile(maxbytes=maxbytes):
-            print('xhighlights: log was rotated.')
         # Set logging level.
         self.setlevel(logging.DEBUG if level is None else level)
 
         # prepare file handler.
         # build handler
-        self.filehandler = logging.FileHandler(self.filename)
+        self.compress = False
+        # Thread for the last gzip of an old logfile, see rotate().
+        self.compressor = None
+        self.filehandler = logging.handlers.RotatingFileHandler(
+            self.filename,
+            maxBytes=maxbytes,
+            backupCount=backups,
+            delay=True
+        )
+        self.filehandler.namer = self.namer
+        self.filehandler.rotator = self.rotate
+        self.rollover = self.filehandler.doRollover
+        self.filehandler.doRollover = self.do_rollover
+        self.set_rotation(maxbytes, backups, compress=compress)
         # format for logging messages
         log_format = ('%(asctime)s - [%(levelname)s] '
                       '%(name)s.%(funcName)s (%(lineno)d):\n %(message)s\n')
         self.formatter = logging.Formatter(log_format)
         self.filehandler.setFormatter(self.formatter)
-        self.log.addHandler(self.filehandler)
+        # The file handler is only used by the listener thread.
+        self.queue = queue.Queue(-1)
+        self.queuehandler = logging.handlers.QueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(
+            self.queue,
+            self.filehandler
+        )
+        self.listener.start()
+        self.log.addHandler(self.queuehandler)
 
-    def rotate_logfile(self, maxbytes=2097152):
-        """ Removes an old log if it is over a certain size.
-            This can't be done while it is in use.
-            It must be done before the logger is initialized.
+    def compress_file(self, filename, destfile):
+        """ Gzip filename into destfile, and remove filename.
+            This runs on its own thread, so errors are only logged
+            (HexChat's print can't be used off the main thread).
         """
-        if os.path.isfile(self.filename):
-            try:
-                logsize = os.path.getsize(self.filename)
-            except:
-                return False
-            if logsize > maxbytes:
-                # Remove old log file.
-                try:
-                    os.remove(self.filename)
-                    return True
-                except:
-                    return False
-        return False
+        try:
+            with open(filename, 'rb') as fread:
+                with gzip.open(destfile, 'wb') as fwrite:
+                    shutil.copyfileobj(fread, fwrite)
+            os.remove(filename)
+        except EnvironmentError as ex:
+            errmsg = 'Unable to compress log: {}'.format(ex)
+            if self.listener is None:
+                # Stopped, the log file can't be used anymore.
+                if sys.__stderr__ is not None:
+                    sys.__stderr__.write('xhighlights: {}\n'.format(errmsg))
+            else:
+                self.log.error(errmsg)
+
+    def do_rollover(self):
+        """ doRollover() for the RotatingFileHandler.
+            The last gzip (see rotate()) must be done before the old
+            segments are renamed, it may still be writing one of them.
+        """
+        self.wait_compressor()
+        return self.rollover()
+
+    def namer(self, name):
+        """ Names old logfiles for the RotatingFileHandler. """
+        if self.compress:
+            return '{}.gz'.format(name)
+        return name
+
+    def rotate(self, source, dest):
+        """ Rotator for the RotatingFileHandler.
+            This runs on the listener thread, with the handler locked.
+            When compressing, the file is renamed right away and gzipped on
+            another thread, so writing new records doesn't wait for it.
+            (the rename of old segments waits, see do_rollover())
+        """
+        if not os.path.exists(source):
+            return None
+        if not (self.compress and dest.endswith('.gz')):
+            os.replace(source, dest)
+            return None
+        tmpname = '{}.rotating'.format(dest[:-3])
+        os.replace(source, tmpname)
+        self.compressor = threading.Thread(
+            target=self.compress_file,
+            args=(tmpname, dest),
+            name='xhighlights-log-gzip',
+            daemon=True
+        )
+        self.compressor.start()
+
+    def set_rotation(self, maxbytes, backups, compress=False):
+        """ Set the size/count policy for rotating the logfile.
+            A maxbytes or backups of 0 disables rotation.
+        """
+        # With no backups, RotatingFileHandler would reopen the file for
+        # every record once it is too big (it never shrinks), so either
+        # 0 turns rotation off.
+        self.filehandler.maxBytes = maxbytes if backups else 0
+        self.filehandler.backupCount = backups
+        self.compress = compress
 
     def setlevel(self, lvl):
         self.level = lvl
         self.log.setLevel(self.level)
 
+    def stop(self):
+        """ Write any queued records, and stop the listener thread. """
+        if self.listener is None:
+            return None
+        self.log.removeHandler(self.queuehandler)
+        self.listener.stop()
+        self.listener = None
+        self.filehandler.close()
+        self.wait_compressor()
+
+    def wait_compressor(self):
+        """ Wait for the last gzip of an old logfile to finish. """
+        if self.compressor is not None:
+            self.compressor.join()
+            self.compressor = None
+
 
 # File for config. CWD is used, it usually defaults to /home/username
 try:
@@ -90,11 +205,18 @@ except Exception:
     CWD = os.getcwd()
 CONFIGFILE = os.path.join(CWD, 'xhighlights.conf')
 LOGFILE = os.path.join(CWD, 'xhighlights.log')
-CUSTOMFILE = os.path.join(CWD, 'xhighlights.pkl')
+CUSTOMFILE = os.path.join(CWD, 'xhighlights.json')
+# Old pickled custom patterns, migrated to CUSTOMFILE when found.
+PICKLEFILE = os.path.join(CWD, 'xhighlights.pkl')
+# Top-level domains for bare domain links, see load_tlds().
+TLDFILE = os.path.join(CWD, 'xhighlights_tlds.txt')
+# Version for the CUSTOMFILE format.
+RULES_VERSION = 1
 
 
 # Logger for xhighlights main.
-_log = logger('xhighlights', level=logging.ERROR).log
+_logger = logger('xhighlights', level=logging.ERROR)
+_log = _logger.log
 _log.debug('{} loaded.'.format(VERSIONSTR))
 
 # Regex for matching a link..
@@ -106,24 +228,50 @@ url_pre = (
 )
 
 # Extension (as found in xchat/src/common/url.c)
+# These are always links, along with the top-level domains in TLDFILE.
 url_ext = ('org', 'net', 'com', 'edu', 'html', 'info', 'name')
-# Start is optional, but will trigger a match.
-start = r'(^({})(.))'.format('|'.join(url_pre))
-# Middle (when no prefix is found, middle and end are required)
-middle = r'([\w\-]+)'
-end = r'([\.]({})([^\w\.]|$))'.format('|'.join(url_ext))
+# This pattern is used with finditer() on the whole message, so every part
+# is kept inside a single space-separated word, and each part can only
+# start at a word start (or a dot) to keep the scan linear.
+# Start of a word (start of the message, or after a space).
+wordstart = r'(?<![^ ])'
+# Prefix will trigger a match (at a word start).
+start = r'(?:{})[^ ][\w\-]+'.format('|'.join(url_pre))
+# End will trigger a match anywhere in a word, after any name.
+# A bare domain is matched from its last dot (only the start of a match is
+# used, to find the word), and find_links() checks the label against TLDS.
+# (Punycode labels are the only ones with a '-', like xn--p1ai)
+end = r'(?<=[\w\-])\.(?P<tld>[^\W\d_]\w*(?:--\w+)?)(?![\w\.])'
 
 # Basic pattern for an email address.
-email = r'(.+\@.+\..+)'
-# Combine all patterns.
-# Middle and End will trigger a match.
-linkpattern = '{}?{}{}'.format(start, middle, end)  # , extended)
-# Prefix will trigger a match.
-linkpattern = ''.join((linkpattern, '|{}{}({})?'.format(start, middle, end)))
-# Email address triggers a match.
-linkpattern = ''.join((linkpattern, '|{}'.format(email)))
+# (something@something.something, '@' is the first one after the first
+#  character, '.' is the first one after the first character past '@')
+# (at a word start)
+email = r'[^ ][^ @]*@[^ ][^ \.]*\.[^ ]'
+# Combine all patterns, the group name is the kind of link.
+# Prefixes and emails share one word start check.
+linkpattern = '{}(?:(?P<link>{})|(?P<email>{}))|(?P<domain>{})'.format(
+    wordstart,
+    start,
+    email,
+    end
+)
 # Final pattern for highlighting a link.
 link_re = re.compile(linkpattern)
+# Every link match needs one of these in the message.
+link_chars = ('.', '://')
+# Pattern for the words in a message, see tokenize_message().
+word_re = re.compile(r'[^ ]+')
+# Characters that continue a word inside a nick, a nick mention can't start
+# or end next to one of these. Brackets are allowed in nicks, but they
+# still count as punctuation around one, like: [nick] or {nick}.
+nick_word_chars = '`^|\\-_'
+# Positions where a nick mention may start, see NickMatcher.find().
+nick_start_re = re.compile(
+    r'(?<![\w{chars}])[\w{chars}\[\]{{}}]'.format(
+        chars=re.escape(nick_word_chars)
+    )
+)
 
 
 # Global flag to stop emit_print recursion.
@@ -134,14 +282,1169 @@ link_re = re.compile(linkpattern)
 EMITTING = False
 
 
-def add_custom_pattern(cmdargs):
+class ContextRules(object):
+
+    """ Holds the effective rules (a RuleSet) for each context, so
+        message_filter() gets them with one dict lookup instead of checking
+        every custom pattern's scopes for every message.
+        Contexts are keyed by (server id, channel name), like NickIndex.
+        Contexts that share the same custom patterns share a CustomMatcher.
+        Everything is dropped when a new RuleSnapshot is used.
+    """
+
+    def __init__(self, excluded=None):
+        # Scopes where nothing is highlighted, see parse_scope().
+        self.excluded = excluded or []
+        # RuleSet by context key.
+        self.rulesets = {}
+        # CustomMatcher by tuple of pattern ids.
+        self.matchers = {}
+        # Number of times a RuleSet has been built.
+        self.builds = 0
+        # Version of the RuleSnapshot these were built from.
+        self.version = None
+
+    def build(self, key, rules):
+        """ Build the RuleSet for the current context. """
+        network = xchat.get_info('network') or ''
+        channel = key[1] or ''
+        excluded = scope_matches(self.excluded, network, channel)
+        allpatterns = rules.matcher.patterns
+        patterns = [
+            patterninfo
+            for patterninfo in allpatterns
+            if (
+                (not patterninfo['scopes']) or
+                scope_matches(patterninfo['scopes'], network, channel)
+            )
+        ]
+        if len(patterns) == len(allpatterns):
+            matcher = rules.matcher
+        else:
+            patternids = tuple(id(p) for p in patterns)
+            matcher = self.matchers.get(patternids, None)
+            if matcher is None:
+                matcher = CustomMatcher(patterns)
+                self.matchers[patternids] = matcher
+        ruleset = RuleSet(matcher, excluded=excluded)
+        self.rulesets[key] = ruleset
+        self.builds += 1
+        return ruleset
+
+    def clear(self):
+        """ Forget all rule sets, they will be rebuilt on the next get(). """
+        self.rulesets = {}
+        self.matchers = {}
+
+    def get(self, key, rules):
+        """ Return the RuleSet for a context key, building it from a
+            RuleSnapshot if needed.
+        """
+        if rules.version != self.version:
+            self.clear()
+            self.version = rules.version
+        ruleset = self.rulesets.get(key, None)
+        if ruleset is None:
+            ruleset = self.build(key, rules)
+        return ruleset
+
+
+class CustomMatch(object):
+
+    """ The part of a CustomMatcher match that belongs to one custom
+        pattern. It has the same groups() and groupdict() that a match
+        from the pattern itself would have, so highlight_custom() can use
+        either one.
+    """
+
+    def __init__(self, rematch, offset, pattern):
+        # Match object from the combined pattern.
+        self.rematch = rematch
+        # Group index for the pattern's wrapper group.
+        self.offset = offset
+        # The original compiled custom pattern.
+        self.pattern = pattern
+
+    def groupdict(self):
+        """ Named groups for the custom pattern, by their original names."""
+        return {
+            name: self.rematch.group(self.offset + index)
+            for name, index in self.pattern.groupindex.items()
+        }
+
+    def groups(self):
+        """ Positional groups for the custom pattern.
+            Only its own groups are fetched, rematch.groups() would build
+            a tuple with every group in the combined pattern.
+        """
+        groupcount = self.pattern.groups
+        if groupcount == 1:
+            return (self.rematch.group(self.offset + 1), )
+        if not groupcount:
+            return ()
+        start = self.offset + 1
+        return self.rematch.group(*range(start, start + groupcount))
+
+
+class CustomMatcher(object):
+
+    """ Matches a word against all of the custom patterns at once.
+        Consecutive patterns are compiled into one named-group alternation,
+        (?P<_c0>...)|(?P<_c1>...), so each word costs a single regex call.
+        Alternation is tried left to right, so the first pattern (in
+        RuleSnapshot.custom order) to match still wins.
+        Patterns that can't be combined (global inline flags, numeric
+        backreferences) are matched by themselves, in the same order.
+        Each segment is timed, segments that go over the time budget are
+        added to Watchdog.overbudget (see quarantine_slow_patterns()).
+        Nothing in a matcher changes after it is built, the counters are
+        kept in PatternStats and Watchdog.
+        Phrase patterns are combined the same way, but they are searched
+        for in the whole message (see find_phrases()).
+    """
+    # Patterns with numeric backreferences/conditionals can't be combined,
+    # their group numbers would change.
+    backref_re = re.compile(r'\\[1-9]|\(\?\(\d')
+    # Named groups/backreferences in a pattern, renamed when combined.
+    groupname_re = re.compile(r'\(\?P(<|=)(\w+)')
+    # Every sample_interval calls to match(), one pattern is timed by itself.
+    sample_interval = 16
+    # Seconds that a single segment may take to match a word.
+    budget = 0.05
+
+    def __init__(self, patterns):
+        # Patterns in the order they are tried (see reorder_patterns()).
+        self.patterns = patterns
+        wordpatterns = []
+        phrasepatterns = []
+        for i, patterninfo in enumerate(patterns):
+            if patterninfo['phrase']:
+                phrasepatterns.append((i, patterninfo))
+            else:
+                wordpatterns.append((i, patterninfo))
+        # Characters that a custom pattern match can start with,
+        # or None when any character might start a match.
+        self.firstchars = self.first_chars(wordpatterns)
+        # Regex that finds a word starting with one of firstchars.
+        self.prescreen_re = None
+        if self.firstchars:
+            self.prescreen_re = re.compile('(?:^| )[{}]'.format(
+                ''.join(re.escape(c) for c in sorted(self.firstchars))
+            ))
+        # Same for phrases, which can start anywhere in a message.
+        self.phrasechars = self.first_chars(phrasepatterns)
+        self.phrase_prescreen_re = None
+        # Combined phrases start with a lookahead for phrasechars, so
+        # finditer() doesn't try every pattern at every position.
+        phrasegate = ''
+        if self.phrasechars:
+            phrasegate = '(?=[{}])'.format(
+                ''.join(re.escape(c) for c in sorted(self.phrasechars))
+            )
+            self.phrase_prescreen_re = re.compile(phrasegate)
+        # List of (compiled, {groupname: (offset, patterninfo)}, None), or
+        # (pattern, None, patterninfo) for patterns matched by themselves.
+        self.segments = self.build_segments(wordpatterns)
+        # Word patterns that made it into a segment (the others don't
+        # compile), timed one at a time by sample().
+        segmentids = set()
+        for _, names, patterninfo in self.segments:
+            if names is None:
+                segmentids.add(id(patterninfo))
+            else:
+                segmentids.update(id(info) for _, info in names.values())
+        self.samplepatterns = [
+            patterninfo
+            for _, patterninfo in wordpatterns
+            if id(patterninfo) in segmentids
+        ]
+        self.phrasesegments = self.build_segments(
+            phrasepatterns,
+            gate=phrasegate
+        )
+
+    def add_combined(self, segments, combinable, validated=False, gate=''):
+        """ Compile wrapped patterns into a single segment.
+            The wrapped patterns are only compiled one by one when the
+            combined pattern fails, to find the ones that can't be combined.
+            A gate (a lookahead) can be put in front of the combined
+            pattern.
+        """
+        if not combinable:
+            return None
+        try:
+            combined = re.compile('{}(?:{})'.format(
+                gate,
+                '|'.join(w for _, w, _ in combinable)
+            ))
+        except re.error as ex:
+            if validated:
+                # Shouldn't happen, they all compiled separately.
+                _log.error('Unable to combine custom patterns: {}'.format(ex))
+                for _, _, patterninfo in combinable:
+                    self.add_single(segments, patterninfo)
+                return None
+            run = []
+            for name, wrapped, patterninfo in combinable:
+                try:
+                    re.compile(wrapped)
+                except re.error:
+                    self.add_combined(
+                        segments,
+                        run,
+                        validated=True,
+                        gate=gate
+                    )
+                    run = []
+                    self.add_single(segments, patterninfo)
+                else:
+                    run.append((name, wrapped, patterninfo))
+            self.add_combined(segments, run, validated=True, gate=gate)
+            return None
+        names = {}
+        for name, _, patterninfo in combinable:
+            names[name] = (combined.groupindex[name], patterninfo)
+        segments.append((combined, names, None))
+
+    @staticmethod
+    def add_single(segments, patterninfo):
+        """ Add a segment for a pattern that is matched by itself.
+            A LazyPattern is compiled here, because it may not have been
+            parsed when it was loaded (see LazyPattern). Patterns that
+            don't compile are logged and left out.
+        """
+        pattern = patterninfo['pattern']
+        if isinstance(pattern, LazyPattern):
+            try:
+                pattern.compile()
+            except re.error as ex:
+                _log.error('Invalid custom pattern: {}\n{}'.format(
+                    pattern.pattern,
+                    ex
+                ))
+                return None
+        segments.append((pattern, None, patterninfo))
+
+    def build_segments(self, indexedpatterns, gate=''):
+        """ Build the list of segments for [(index, patterninfo), ...],
+            where consecutive patterns that can be combined are.
+            See add_combined() for gate.
+        """
+        segments = []
+        combinable = []
+        for i, patterninfo in indexedpatterns:
+            wrapped = self.wrap_pattern(i, patterninfo)
+            if wrapped is None:
+                self.add_combined(segments, combinable, gate=gate)
+                combinable = []
+                self.add_single(segments, patterninfo)
+            else:
+                name = '_c{}'.format(i)
+                combinable.append((name, wrapped, patterninfo))
+        self.add_combined(segments, combinable, gate=gate)
+        return segments
+
+    def candidate_words(self, msg, wordstarts):
+        """ Yields the index of each word (from wordstarts) in a message
+            that could possibly match one of the custom patterns.
+        """
+        if self.firstchars is None:
+            for i in range(len(wordstarts)):
+                yield i
+            return
+        if self.prescreen_re is None:
+            return
+        for prematch in self.prescreen_re.finditer(msg):
+            # The match ends with the first character of a word.
+            yield bisect_right(wordstarts, prematch.end() - 1) - 1
+
+    def find_phrases(self, msg):
+        """ Find phrase pattern matches in the whole message, with one
+            finditer() per segment (usually just one).
+            Returns a sorted list of non-overlapping
+            (start, end, patterninfo, match). Where matches overlap, the
+            leftmost wins, and then the first pattern.
+        """
+        if not self.phrasesegments:
+            return []
+        if self.phrasechars is not None:
+            if self.phrase_prescreen_re is None:
+                return []
+            if self.phrase_prescreen_re.search(msg) is None:
+                return []
+        clock = time.perf_counter
+        found = []
+        for order, segment in enumerate(self.phrasesegments):
+            pattern, names, patterninfo = segment
+            start = clock()
+            for rematch in pattern.finditer(msg):
+                matchstart, matchend = rematch.span()
+                if matchstart == matchend:
+                    continue
+                if names is None:
+                    found.append(
+                        (matchstart, order, matchend, patterninfo, rematch)
+                    )
+                    continue
+                offset, phraseinfo = names[rematch.lastgroup]
+                found.append((
+                    matchstart,
+                    order,
+                    matchend,
+                    phraseinfo,
+                    CustomMatch(rematch, offset, phraseinfo['pattern']),
+                ))
+            elapsed = clock() - start
+            if elapsed > self.budget:
+                Watchdog.overbudget.append((segment, elapsed, msg))
+        if len(self.phrasesegments) > 1:
+            found.sort(key=lambda f: f[:2])
+        phrases = []
+        last = 0
+        for matchstart, _, matchend, patterninfo, rematch in found:
+            if matchstart < last:
+                continue
+            patterninfo['stats'].hits += 1
+            phrases.append((matchstart, matchend, patterninfo, rematch))
+            last = matchend
+        return phrases
+
+    @staticmethod
+    def first_chars(indexedpatterns):
+        """ Returns the set of characters that any of these patterns
+            [(index, patterninfo), ...] can start with, or None when any
+            character might start one (see first_chars()).
+        """
+        chars = set()
+        for _, patterninfo in indexedpatterns:
+            patternchars = patterninfo['firstchars']
+            if patternchars is None:
+                return None
+            chars.update(patternchars)
+        return chars
+
+    def has_candidates(self, msg):
+        """ Returns True if any word in this message could possibly match
+            one of the custom patterns, or if the message could have a
+            phrase.
+        """
+        if self.phrasesegments:
+            if self.phrasechars is None:
+                return True
+            prescreen_re = self.phrase_prescreen_re
+            if prescreen_re is not None and prescreen_re.search(msg):
+                return True
+        if self.firstchars is None:
+            return True
+        if self.prescreen_re is None:
+            return False
+        return self.prescreen_re.search(msg) is not None
+
+    def match(self, word):
+        """ Returns (patterninfo, match) for the first custom pattern that
+            matches this word, or (None, None).
+        """
+        Watchdog.calls += 1
+        if not Watchdog.calls % self.sample_interval:
+            self.sample(word)
+        clock = time.perf_counter
+        for segment in self.segments:
+            pattern, names, patterninfo = segment
+            start = clock()
+            rematch = pattern.match(word)
+            elapsed = clock() - start
+            if elapsed > self.budget:
+                Watchdog.overbudget.append((segment, elapsed, word))
+            if rematch is None:
+                continue
+            if names is not None:
+                # Combined segment, the wrapper group tells us which one.
+                offset, patterninfo = names[rematch.lastgroup]
+                patterninfo['stats'].hits += 1
+                return patterninfo, CustomMatch(
+                    rematch,
+                    offset,
+                    patterninfo['pattern']
+                )
+            patterninfo['stats'].hits += 1
+            return patterninfo, rematch
+        return None, None
+
+    def sample(self, word):
+        """ Time one word pattern (each one in turn) by itself against a
+            word. Phrase patterns are skipped, they don't match words.
+            The times are shown by print_custom_patterns().
+        """
+        patterns = self.samplepatterns
+        if not patterns:
+            return None
+        patterninfo = patterns[Watchdog.sampleindex % len(patterns)]
+        Watchdog.sampleindex += 1
+        pattern = patterninfo['pattern']
+        if isinstance(pattern, LazyPattern) and (pattern.compiled is None):
+            # Compile it first, so that isn't timed.
+            pattern.compile()
+        start = time.perf_counter()
+        pattern.match(word)
+        elapsed = time.perf_counter() - start
+        stats = patterninfo['stats']
+        stats.evaltime += elapsed
+        stats.evals += 1
+        if elapsed > self.budget:
+            segment = (pattern, None, patterninfo)
+            Watchdog.overbudget.append((segment, elapsed, word))
+
+    def wrap_pattern(self, index, patterninfo):
+        """ Wrap a custom pattern in a named group so it can be combined
+            with others. Returns None if it can't be combined.
+            (add_combined() finds any others that fail to compile)
+        """
+        pattern = patterninfo['pattern']
+        pattxt = pattern.pattern
+        if pattern.flags & ~re.UNICODE:
+            # Global inline flags, they would apply to every pattern.
+            return None
+        if self.backref_re.search(pattxt):
+            return None
+        prefix = '_c{}_'.format(index)
+        pattxt = self.groupname_re.sub(
+            lambda m: '(?P{}{}{}'.format(m.group(1), prefix, m.group(2)),
+            pattxt
+        )
+        return '(?P<_c{}>{})'.format(index, pattxt)
+
+
+class EventPipeline(object):
+
+    """ How message_filter() handles one print event: where the message
+        is in `word`, and which highlighting stages apply to it.
+        These are built once, when the event is hooked (they are the hook's
+        userdata), so message_filter() never checks the event name.
+    """
+
+    def __init__(self, event, msgindex=1, nicks=True):
+        # Print event name, used to emit the highlighted message.
+        self.event = event
+        # Index of the message in `word` (the nick is always word[0]).
+        self.msgindex = msgindex
+        # Whether nicks in the message are highlighted.
+        self.nicks = nicks
+
+    def __repr__(self):
+        return '{}({!r}, msgindex={!r}, nicks={!r})'.format(
+            type(self).__name__,
+            self.event,
+            self.msgindex,
+            self.nicks,
+        )
+
+
+class FloodMonitor(object):
+
+    """ Tracks the message rate for one context, and picks the highlight
+        mode for each message. Over `threshold` lines in one second it
+        switches to `floodmode`:
+            links : Only links are highlighted.
+            pass  : Messages are passed through, with no re-emit.
+        It goes back to normal when the rate drops under half of that.
+        Time spent in each mode is kept for print_stats().
+    """
+    # Lines per second to switch to floodmode (0 disables it).
+    threshold = 0
+    floodmode = 'links'
+    modes = ('normal', 'links', 'pass')
+
+    def __init__(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.mode = 'normal'
+        self.modestart = now
+        # Seconds spent in each mode, not counting the current one.
+        self.modetimes = {}
+        # Number of times the flood mode was started.
+        self.floods = 0
+        # Lines counted since windowstart.
+        self.count = 0
+        self.windowstart = now
+
+    def check(self, now):
+        """ Count one line, and return the mode to use for it. """
+        self.count += 1
+        elapsed = now - self.windowstart
+        if elapsed >= 1.0:
+            rate = self.count / elapsed
+            self.count = 0
+            self.windowstart = now
+            if (self.mode != 'normal') and (rate < (self.threshold / 2)):
+                self.set_mode('normal', now)
+        elif (self.mode == 'normal') and (self.count > self.threshold):
+            self.set_mode(self.floodmode, now)
+        return self.mode
+
+    def mode_times(self, now=None):
+        """ Returns {mode: seconds} for all modes, including the current
+            one.
+        """
+        now = time.monotonic() if now is None else now
+        modetimes = {mode: self.modetimes.get(mode, 0) for mode in self.modes}
+        modetimes[self.mode] += now - self.modestart
+        return modetimes
+
+    def set_mode(self, mode, now):
+        """ Switch modes, and add up the time spent in the last one. """
+        self.modetimes[self.mode] = (
+            self.modetimes.get(self.mode, 0) + (now - self.modestart)
+        )
+        if mode != 'normal':
+            self.floods += 1
+        self.mode = mode
+        self.modestart = now
+
+
+class HookProfiler(object):
+
+    """ Profiles the next `count` message_filter() calls with cProfile,
+        for /xhighlights --profile (see start_profile()).
+        The profiled hooks are only swapped in while it runs, so there is
+        no cost when nothing is being profiled.
+        Highlighted messages are emitted inside the call, so the emit path
+        is part of the profile too.
+    """
+
+    def __init__(self, count):
+        # Number of calls to profile.
+        self.count = count
+        # Number of calls profiled so far.
+        self.calls = 0
+        self.profile = cProfile.Profile()
+        # Timer hook that puts the normal hooks back, see finish_profile().
+        self.timer = None
+
+    def wrap(self, func):
+        """ Wrap a print hook function, so calls are profiled until count
+            is reached.
+        """
+        def profiled_hook_func(word, word_eol, userdata):
+            if EMITTING or (self.calls >= self.count):
+                return func(word, word_eol, userdata)
+            self.calls += 1
+            result = self.profile.runcall(func, word, word_eol, userdata)
+            if (self.calls >= self.count) and (self.timer is None):
+                # Hooks shouldn't be swapped while the event is running.
+                self.timer = xchat.hook_timer(1, finish_profile)
+            return result
+
+        return profiled_hook_func
+
+
+class HookStats(object):
+
+    """ Call counters and a latency histogram for one print hook.
+        Histogram buckets are log2 of the call time in microseconds,
+        bucket i holds calls that took less than 2 ** i microseconds.
+        Percentiles are reported as a bucket's upper bound.
+    """
+    # Number of histogram buckets (the last one is ~8 seconds and up).
+    bucketcount = 24
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def percentile(self, pct):
+        """ Returns the upper bound (microseconds) of the bucket that holds
+            the pct percentile call time.
+        """
+        if not self.calls:
+            return 0
+        target = self.calls * (pct / 100)
+        seen = 0
+        for i, bucketcalls in enumerate(self.histogram):
+            seen += bucketcalls
+            if seen >= target:
+                return 2 ** i
+        return 2 ** (self.bucketcount - 1)
+
+    def record(self, elapsed, result):
+        """ Record one call, that took `elapsed` seconds and returned
+            `result` (EAT_ALL for a re-emit, EAT_NONE for a skip).
+        """
+        self.calls += 1
+        if result == xchat.EAT_NONE:
+            self.skips += 1
+        else:
+            self.emits += 1
+        self.total += elapsed
+        if elapsed > self.maxtime:
+            self.maxtime = elapsed
+        bucket = int(elapsed * 1000000).bit_length()
+        if bucket >= self.bucketcount:
+            bucket = self.bucketcount - 1
+        self.histogram[bucket] += 1
+
+    def reset(self):
+        """ Reset all counters. """
+        self.calls = 0
+        self.emits = 0
+        self.skips = 0
+        self.total = 0.0
+        self.maxtime = 0.0
+        self.histogram = [0] * self.bucketcount
+
+
+class LazyPattern(object):
+
+    """ A custom pattern loaded from CUSTOMFILE. It is only compiled the
+        first time it is matched by itself, because CustomMatcher compiles
+        all of the patterns together anyway.
+        The rule file keeps what is needed from parsing the pattern
+        (see pattern_rule()), so a pattern is only parsed when that is
+        missing or belongs to other pattern text (see rule_parsed()),
+        and the combined compile is the only parse otherwise.
+        It has the same pattern/flags/groups/groupindex attributes and
+        match()/search()/finditer() methods that a compiled pattern has.
+        Raises re.error for invalid patterns (when they are parsed).
+    """
+
+    def __init__(self, pattern, parsed=None):
+        if not isinstance(pattern, str):
+            raise TypeError('Pattern must be a str: {!r}'.format(pattern))
+        self.pattern = pattern
+        self.compiled = None
+        if parsed is not None:
+            try:
+                self.flags = int(parsed['flags'])
+                self.groups = int(parsed['groups'])
+                self.groupindex = {
+                    str(name): int(index)
+                    for name, index in parsed['groupindex'].items()
+                }
+                firstchars = parsed['firstchars']
+                self.firstchars = None if firstchars is None else set(
+                    str(firstchars)
+                )
+            except (AttributeError, KeyError, TypeError, ValueError) as ex:
+                _log.error('Bad parse info for pattern: {}\n{}'.format(
+                    pattern,
+                    ex
+                ))
+            else:
+                return None
+        parsed = sre_parse.parse(pattern)
+        # Python 3.11+ uses .state, older versions use .pattern.
+        state = getattr(parsed, 'state', None) or parsed.pattern
+        self.flags = state.flags
+        # state.groups includes group 0.
+        self.groups = state.groups - 1
+        self.groupindex = dict(state.groupdict)
+        # Saves parsing again in first_chars().
+        self.firstchars = first_chars_parsed(parsed)
+
+    @staticmethod
+    def checksum(pattern):
+        """ Checksum of a pattern's text, saved with its parse info. """
+        return zlib.crc32(pattern.encode('utf-8', 'surrogatepass'))
+
+    def compile(self):
+        """ Compile the pattern if needed, and return the compiled one. """
+        if self.compiled is None:
+            self.compiled = re.compile(self.pattern)
+        return self.compiled
+
+    def finditer(self, *args, **kwargs):
+        """ Compile the pattern if needed, and finditer() with it. """
+        return self.compile().finditer(*args, **kwargs)
+
+    def match(self, *args, **kwargs):
+        """ Compile the pattern if needed, and match it. """
+        return self.compile().match(*args, **kwargs)
+
+    @classmethod
+    def rule_parsed(cls, rule):
+        """ Returns the parse info from a rule dict (see pattern_rule()),
+            or None if it has none, or if it was saved for some other
+            pattern text (the rule was edited).
+        """
+        if not isinstance(rule, dict):
+            return None
+        parsed = rule.get('parsed', None)
+        pattern = rule.get('pattern', None)
+        if not (isinstance(parsed, dict) and isinstance(pattern, str)):
+            return None
+        if parsed.get('crc32', None) != cls.checksum(pattern):
+            return None
+        return parsed
+
+    def search(self, *args, **kwargs):
+        """ Compile the pattern if needed, and search with it. """
+        return self.compile().search(*args, **kwargs)
+
+
+class NickIndex(object):
+
+    """ Holds a NickMatcher (with its set of nicks) for each channel context,
+        so nick lookups in message_filter() don't have to call
+        get_list('users') for every message. Each one is built once from
+        the user list, and then kept current by the Join/Part/Kick/Quit/
+        Change Nick event hooks.
+        Contexts are keyed by (server id, channel name).
+    """
+
+    def __init__(self):
+        self.matchers = {}
+        # Number of times a nick set has been (re)built from get_list().
+        self.rebuilds = 0
+
+    def add(self, key, nick):
+        """ Add a nick to an existing nick set. """
+        matcher = self.matchers.get(key, None)
+        if matcher is not None:
+            matcher.add(nick)
+
+    def discard(self, key, nick):
+        """ Remove a nick from an existing nick set. """
+        matcher = self.matchers.get(key, None)
+        if matcher is not None:
+            matcher.discard(nick)
+
+    def get(self, key):
+        """ Return the NickMatcher for a context key, building it if needed.
+        """
+        matcher = self.matchers.get(key, None)
+        if matcher is None:
+            matcher = self.rebuild(key)
+        return matcher
+
+    def invalidate(self, key):
+        """ Forget a nick set, it will be rebuilt on the next get(). """
+        self.matchers.pop(key, None)
+
+    def rebuild(self, key):
+        """ Build a nick set from the current context's user list. """
+        matcher = NickMatcher(u.nick for u in xchat.get_list('users'))
+        self.matchers[key] = matcher
+        self.rebuilds += 1
+        return matcher
+
+    def rename(self, key, oldnick, newnick):
+        """ Replace a nick in an existing nick set. """
+        matcher = self.matchers.get(key, None)
+        if matcher is not None:
+            matcher.discard(oldnick)
+            matcher.add(newnick)
+
+
+class NickMatcher(object):
+
+    """ Finds every nick mentioned in a message in one pass, no matter how
+        many nicks there are.
+        This is an Aho-Corasick style automaton (a trie of all nicks), but
+        a mention has to start and end on a word boundary, so the scan
+        only starts at word boundaries (see nick_start_re) and a failed
+        walk never has to fall back into the middle of a word. That makes
+        the failure links unnecessary, and the scan stays linear in the
+        message length.
+        Nicks are added to the trie as they join. Removed nicks are only
+        dropped from the set (the trie is checked against it), and the trie
+        is rebuilt once there are more stale entries than live ones.
+    """
+    # Source of version numbers, shared so they are never reused.
+    versions = count()
+
+    def __init__(self, nicks=None):
+        # Live set of nicks.
+        self.nicks = set()
+        # Trie of {char: node}, node[None] is the nick ending there.
+        self.root = {}
+        # Length of the longest nick in the trie.
+        self.maxlen = 0
+        # Number of nicks in the trie that are no longer in the set.
+        self.stale = 0
+        for nick in (nicks or ()):
+            self.add(nick)
+        # Changes whenever the nick set changes (used by RenderCache).
+        self.version = next(self.versions)
+
+    def __contains__(self, nick):
+        return nick in self.nicks
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def add(self, nick):
+        """ Add a nick to the set and the trie. """
+        if not nick:
+            return None
+        live = nick in self.nicks
+        self.nicks.add(nick)
+        node = self.root
+        for c in nick:
+            node = node.setdefault(c, {})
+        if (not live) and (node.get(None, None) == nick):
+            # A discarded nick came back, its trie entry is live again.
+            self.stale -= 1
+        node[None] = nick
+        self.maxlen = max(self.maxlen, len(nick))
+        self.version = next(self.versions)
+
+    def discard(self, nick):
+        """ Remove a nick from the set, the trie is rebuilt when needed. """
+        if nick not in self.nicks:
+            return None
+        self.nicks.discard(nick)
+        self.stale += 1
+        self.version = next(self.versions)
+        if self.stale > max(64, len(self.nicks)):
+            self.rebuild()
+
+    def find(self, msg, exclude=None, limit=None):
+        """ Returns a list of (start, end) for each nick mentioned in msg.
+            The longest nick at each position wins.
+            Arguments:
+                msg     : The message to search.
+                exclude : A nick that is never matched (the users own).
+                limit   : Stop after this many mentions.
+        """
+        spans = []
+        if not self.nicks:
+            return spans
+        msglen = len(msg)
+        nicks = self.nicks
+        root = self.root
+        lastend = 0
+        for startmatch in nick_start_re.finditer(msg):
+            start = startmatch.start()
+            if start < lastend:
+                continue
+            node = root
+            best = 0
+            for i in range(start, min(msglen, start + self.maxlen)):
+                node = node.get(msg[i], None)
+                if node is None:
+                    break
+                nick = node.get(None, None)
+                if nick is None:
+                    continue
+                nextchar = msg[i + 1:i + 2]
+                if is_nick_char(nextchar):
+                    # Not the end of a word.
+                    continue
+                if (nick in nicks) and (nick != exclude):
+                    best = i + 1
+            if best:
+                spans.append((start, best))
+                lastend = best
+                if limit and len(spans) >= limit:
+                    break
+        return spans
+
+    def rebuild(self):
+        """ Rebuild the trie from the live nick set. """
+        nicks = self.nicks
+        self.nicks = set()
+        self.root = {}
+        self.maxlen = 0
+        self.stale = 0
+        for nick in nicks:
+            self.add(nick)
+
+
+class PatternStats(object):
+
+    """ Usage counters for one custom pattern. They are kept out of the
+        rules themselves (see RuleSnapshot), and every copy of a pattern's
+        info shares the same PatternStats, so they survive rule changes.
+    """
+
+    __slots__ = ('evals', 'evaltime', 'hits')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Reset all counters. """
+        # Matches, see CustomMatcher.match() and message_filter().
+        self.hits = 0
+        # Number of timed matches and their total time in seconds,
+        # see CustomMatcher.sample().
+        self.evals = 0
+        self.evaltime = 0.0
+
+
+class PrefStore(object):
+
+    """ Holds the preferences from a config file in memory.
+        The file is only read again when its modification time changes,
+        and written atomically (temp file and rename). Inside a batch(),
+        changes are only written once, when the batch ends.
+        Config lines look like: option = value
+        Other lines (like comments) are kept, in order, when it is saved.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.prefs = OrderedDict()
+        # Lines of the file as (option, None) or (None, other line text).
+        self.lines = []
+        # Modification time of the file when it was last read/written.
+        self.mtime = None
+        # Nesting level for batch().
+        self.batchlevel = 0
+        # Whether there are unsaved changes (in a batch).
+        self.dirty = False
+
+    @contextmanager
+    def batch(self):
+        """ Context manager, delays writing changes until it exits. """
+        self.batchlevel += 1
+        try:
+            yield self
+        finally:
+            self.batchlevel -= 1
+            if (not self.batchlevel) and self.dirty:
+                self.save()
+
+    def get(self, opt, default=None):
+        """ Get a preference value (string), or default if it isn't set. """
+        self.reload()
+        return self.prefs.get(opt, default)
+
+    def get_mtime(self):
+        """ Return the config file's modification time, or None. """
+        try:
+            return os.stat(self.filename).st_mtime
+        except EnvironmentError:
+            return None
+
+    def load(self):
+        """ Read all preferences from the config file.
+            Returns True on success, False on failure.
+        """
+        self.mtime = self.get_mtime()
+        self.prefs.clear()
+        self.lines = []
+        if self.mtime is None:
+            # No config file yet.
+            return True
+        try:
+            with open(self.filename, 'r') as fread:
+                for line in fread:
+                    opt, sep, val = line.partition('=')
+                    opt = opt.strip()
+                    if not (sep and opt):
+                        self.lines.append((None, line.rstrip('\n')))
+                        continue
+                    if opt not in self.prefs:
+                        self.lines.append((opt, None))
+                    self.prefs[opt] = val.strip()
+        except EnvironmentError as ex:
+            print_error(
+                'Unable to open config file: {}'.format(self.filename),
+                exc=ex,
+                boldtext=self.filename
+            )
+            return False
+        return True
+
+    def reload(self):
+        """ Read the config file again if it has changed. """
+        if self.dirty:
+            # Unsaved changes win.
+            return None
+        if self.get_mtime() != self.mtime:
+            self.load()
+
+    def save(self):
+        """ Write all preferences to the config file, atomically.
+            Options and other lines keep their place, new options are
+            added at the end.
+            Returns True on success, False on failure.
+        """
+        lines = []
+        written = set()
+        for opt, text in self.lines:
+            if opt is None:
+                lines.append(text)
+            elif opt in self.prefs:
+                lines.append('{} = {}'.format(opt, self.prefs[opt]))
+                written.add(opt)
+        for opt, val in self.prefs.items():
+            if opt not in written:
+                self.lines.append((opt, None))
+                lines.append('{} = {}'.format(opt, val))
+        try:
+            write_atomic(self.filename, ''.join(
+                '{}\n'.format(line) for line in lines
+            ))
+        except EnvironmentError as ex:
+            print_error(
+                'Unable to write to config file: {}'.format(self.filename),
+                exc=ex,
+                boldtext=self.filename
+            )
+            return False
+        self.dirty = False
+        self.mtime = self.get_mtime()
+        return True
+
+    def set(self, opt, val):
+        """ Set a preference, and save it (unless in a batch()).
+            Returns True on success, False on failure.
+        """
+        self.reload()
+        val = str(val)
+        if self.prefs.get(opt, None) == val:
+            # Pref already set.
+            return True
+        self.prefs[opt] = val
+        self.dirty = True
+        if self.batchlevel:
+            return True
+        return self.save()
+
+
+class RenderCache(object):
+
+    """ A bounded LRU cache of rendered messages for message_filter().
+        Bot and relay channels repeat the same lines, this saves
+        highlighting them again.
+        Keys include the rule and nick set versions, so changes to styles,
+        custom patterns, or a channel's nicks never return stale output.
+        The cache is also cleared when the rules change.
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        """ Remove all cached items (counters are kept). """
+        self.items.clear()
+
+    def get(self, key, default=None):
+        """ Get a cached item, and mark it as recently used. """
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def hit_percent(self):
+        """ Percentage of get() calls that were hits. """
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return (self.hits / total) * 100
+
+    def set(self, key, value):
+        """ Cache an item, removing the least recently used if needed. """
+        if self.maxsize < 1:
+            return None
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+class RuleSet(object):
+
+    """ The effective rules for one context, see ContextRules. """
+
+    def __init__(self, matcher, excluded=False):
+        # CustomMatcher with the custom patterns scoped to this context.
+        self.matcher = matcher
+        # Whether highlighting is turned off for this context.
+        self.excluded = excluded
+
+
+class RuleSnapshot(object):
+
+    """ An immutable, versioned copy of the active highlighting rules:
+        the custom patterns (with their compiled templates and styles),
+        the combined matcher built from them, and the link/nick styles.
+        Snapshots are never changed. Edits build a new one with replace(),
+        and swap_rules() makes it active with a single assignment, so
+        anything holding a snapshot always sees one consistent rule set.
+        Every snapshot gets a new version (used by RenderCache).
+        Counters that change while matching are not part of the rules,
+        they are kept in each pattern's PatternStats, and in Watchdog.
+    """
+
+    __slots__ = ('custom', 'link', 'matcher', 'nick', 'version')
+    # Source of version numbers, shared so they are never reused.
+    versions = count()
+
+    def __init__(self, custom=(), link='', nick='', matcher=None):
+        custom = tuple(custom)
+        if matcher is None:
+            matcher = CustomMatcher(matcher_patterns(custom))
+        setattr_ = object.__setattr__
+        # Custom patterns (patterninfo dicts, see build_patterninfo()).
+        setattr_(self, 'custom', custom)
+        # Style codes for links and nicks.
+        setattr_(self, 'link', link)
+        setattr_(self, 'nick', nick)
+        # Combined matcher for custom, see CustomMatcher.
+        setattr_(self, 'matcher', matcher)
+        setattr_(self, 'version', next(self.versions))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            'RuleSnapshot is read-only, use replace(): {}'.format(name)
+        )
+
+    def replace(self, **changes):
+        """ Return a new snapshot with some of the rules changed.
+            The matcher is rebuilt when the custom patterns change,
+            unless a new one is given.
+        """
+        if ('custom' in changes) and ('matcher' not in changes):
+            changes['matcher'] = None
+        for name in ('custom', 'link', 'matcher', 'nick'):
+            changes.setdefault(name, getattr(self, name))
+        return RuleSnapshot(**changes)
+
+
+class Watchdog(object):
+    """ Time budget state for custom patterns, shared by every
+        CustomMatcher (matchers are part of a RuleSnapshot, and never
+        change). See CustomMatcher.budget.
+    """
+    # Calls to CustomMatcher.match(), see CustomMatcher.sample_interval.
+    calls = 0
+    # Index of the next pattern to time in CustomMatcher.sample().
+    sampleindex = 0
+    # List of (segment, seconds, text) that went over the time budget,
+    # see quarantine_slow_patterns().
+    overbudget = []
+
+
+def add_custom_pattern(cmdargs, phrase=False):
     """ Add a custom pattern to highlight/replace.
         Based on user arguments from --add command.
         Expects: 'pattern style template'
+        For phrase patterns (--add --phrase) the pattern may have spaces,
+        and the template is required: 'pattern with spaces style template'
     """
 
     # Parse user args for --add.
-    argparts = cmdargs.split(' ')
+    if phrase:
+        argparts = cmdargs.rsplit(' ', 2)
+        if len(argparts) < 3:
+            errmsg = 'Phrase patterns need a style and template: {}'.format(
+                cmdargs
+            )
+            print_error(errmsg, boldtext=cmdargs)
+            return None
+    else:
+        argparts = cmdargs.split(' ')
     if len(argparts) == 3:
         pattxt, style, template = argparts
     elif len(argparts) == 2:
@@ -158,26 +1461,12 @@ def add_custom_pattern(cmdargs):
         errmsg = 'Invalid pattern for --add: {}'.format(pattxt)
         print_error(errmsg, exc=exre, boldtext=pattxt)
         return None
-    # Test template.
+    # Make sure it can't stall every message (catastrophic backtracking).
     try:
-        fmted = template.format('test')
-    except (KeyError, ValueError) as extmp:
-        errmsgs = [str(extmp)]
-        try:
-            keypat = re.compile(r'\{(\w+)[:\}]')
-            keynames = keypat.findall(template)
-            fmted = template.format(**{k: 'test' for k in keynames})
-        except KeyError as exdict:
-            errmsgs.append(str(exdict))
-            errheader = 'Invalid template for --add: {}'.format(template)
-            errmsgs.insert(0, errheader)
-            errmsg = '\n'.join(errmsgs)
-            print_error(errmsg, boldtext=template)
-            return None
-    # Make sure the template wasn't empty.
-    if not fmted:
-        errmsg = 'Invalid (empty) template for --add!'
-        print_error(errmsg)
+        check_pattern_speed(custompat, phrase=phrase)
+    except ValueError as exslow:
+        errmsg = 'Pattern is too slow for --add: {}'.format(pattxt)
+        print_error(errmsg, exc=exslow, boldtext=pattxt)
         return None
     # Test style.
     style = style.lower().strip()
@@ -185,18 +1474,117 @@ def add_custom_pattern(cmdargs):
     if not stylecodes:
         # get_stylecodes() will already print the error. Just return here.
         return None
+    # Test template, it must work with the pattern's groups.
+    try:
+        custompat = build_patterninfo(
+            custompat,
+            style,
+            template,
+            stylecodes,
+            phrase=phrase,
+            checked=True
+        )
+    except ValueError as extmp:
+        errmsg = 'Invalid template for --add: {}'.format(template)
+        print_error(errmsg, exc=extmp, boldtext=template)
+        return None
 
     # We have a successful pattern, style, and template.
-    custompat = {
-        'pattern': custompat,
-        'patterntext': pattxt,
+    rules = Codes.rules
+    swap_rules(rules.replace(custom=rules.custom + (custompat, )))
+    save_user_patterns()
+    return None
+
+
+def build_patterninfo(
+        pattern, style, template, stylecodes=None, quarantined=False,
+        scopes=None, phrase=False, checked=False):
+    """ Build the info dict for a custom pattern, see RuleSnapshot.
+        Arguments:
+            pattern     : Compiled pattern (or LazyPattern).
+            style       : User style string (comma-separated styles).
+            template    : Replacement template.
+            stylecodes  : Style codes for style, if they are already known.
+            quarantined : Whether the pattern was too slow, and is not
+                          used anymore (see quarantine_slow_patterns()).
+            scopes      : Scopes (network/channel globs) where the pattern
+                          is used, or None for everywhere.
+            phrase      : Whether the pattern is matched against the whole
+                          message, instead of single words.
+            checked     : Whether the pattern passed check_pattern_speed().
+        Raises ValueError if the template can't be used with the pattern.
+    """
+    if stylecodes is None:
+        stylecodes = try_stylecodes(parse_styles(style))
+    return {
+        'pattern': pattern,
+        'patterntext': pattern.pattern,
+        # Parsed once here, see first_chars().
+        'firstchars': first_chars(pattern),
+        'render': build_renderer(pattern, template, stylecodes),
         'stylecodes': stylecodes,
         'style': style,
-        'template': template
+        'template': template,
+        # Counters, not part of the rules (see PatternStats).
+        'stats': PatternStats(),
+        'quarantined': bool(quarantined),
+        'scopes': tuple(scopes or ()),
+        'phrase': bool(phrase),
+        'checked': bool(checked),
     }
-    Codes.custom.append(custompat)
-    save_user_patterns()
-    return None
+
+
+def build_renderer(pattern, template, stylecodes):
+    """ Compile a custom pattern's template into a function that renders
+        a styled replacement: render(word, rematch).
+        The pattern's groups decide how the template is filled:
+            named groups      : template.format(**rematch.groupdict())
+            positional groups : template.format(*rematch.groups())
+            no groups         : template.format(word)
+        Raises ValueError if the template doesn't work with the pattern,
+        or if it renders an empty string.
+    """
+    if pattern.groupindex:
+        testargs = ()
+        testkwargs = {name: 'test' for name in pattern.groupindex}
+    elif pattern.groups:
+        testargs = ('test', ) * pattern.groups
+        testkwargs = {}
+    else:
+        testargs = ('test', )
+        testkwargs = {}
+    try:
+        fmted = template.format(*testargs, **testkwargs)
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError) as ex:
+        if isinstance(ex, KeyError):
+            errmsg = 'No group named {} in the pattern.'.format(ex)
+        elif isinstance(ex, IndexError) and pattern.groupindex:
+            errmsg = 'The pattern has named groups: {}'.format(
+                ', '.join(sorted(pattern.groupindex))
+            )
+        elif isinstance(ex, IndexError):
+            errmsg = 'The pattern has {} groups, and no named groups.'.format(
+                pattern.groups
+            )
+        else:
+            errmsg = str(ex)
+        raise ValueError(errmsg)
+    if not fmted:
+        raise ValueError('Template is empty.')
+
+    # Style codes and reset are part of the compiled template.
+    fulltemplate = ''.join((
+        stylecodes.replace('{', '{{').replace('}', '}}'),
+        template,
+        Codes.normal,
+    ))
+    if pattern.groupindex:
+        fmt_map = fulltemplate.format_map
+        return lambda word, rematch: fmt_map(rematch.groupdict())
+    fmt = fulltemplate.format
+    if pattern.groups:
+        return lambda word, rematch: fmt(*rematch.groups())
+    return lambda word, rematch: fmt(word)
 
 
 def build_color_table():
@@ -238,6 +1626,44 @@ def build_color_table():
     return colors
 
 
+def build_style_table(colors):
+    """ Builds a dict of {(colorname, bold, underline): (prefix, suffix)}
+        for every color name in colors, and returns it.
+        (see get_style())
+    """
+    boldcode = colors['bold']['code']
+    underlinecode = colors['underline']['code']
+    resetcode = colors['reset']['code']
+    styles = {}
+    for colorname, colorinfo in colors.items():
+        for bold in (False, True):
+            for underline in (False, True):
+                prefix = ''.join((
+                    boldcode if bold else '',
+                    underlinecode if underline else '',
+                    colorinfo['code'],
+                ))
+                styles[(colorname, bold, underline)] = (prefix, resetcode)
+    return styles
+
+
+def check_pattern_speed(pattern, phrase=False):
+    """ Time a custom pattern against crafted strings (see probe_strings())
+        that make catastrophic backtracking show up, like (a+)+$ does.
+        Raises ValueError if it goes over CustomMatcher.budget.
+    """
+    elapsed, probe = probe_pattern(
+        pattern,
+        probe_strings(pattern),
+        phrase=phrase
+    )
+    if elapsed > CustomMatcher.budget:
+        raise ValueError('It took {:0.0f}ms for {} chars.'.format(
+            elapsed * 1000,
+            len(probe)
+        ))
+
+
 def cmd_xhighlights(word, word_eol, userdata):
     """ Handles / XHIGHLIGHTS command.
         Allows you to set default colors / styles.
@@ -252,13 +1678,19 @@ def cmd_xhighlights(word, word_eol, userdata):
             ('-l', '--link', False),
             ('-n', '--nick', False),
             ('-p', '--patterns', False),
+            ('-P', '--phrase', False),
             ('-r', '--remove', False),
+            ('-R', '--reset', False),
+            ('-s', '--stats', False),
+            ('-S', '--scope', False),
+            ('-t', '--profile', False),
+            ('-x', '--exclude', False),
         ])
     cmdargsraw = get_cmd_rest(word).strip()
     cmdargs = cmdargsraw.lower()
     # Add a custom pattern.
     if argd['--add']:
-        add_custom_pattern(cmdargsraw)
+        add_custom_pattern(cmdargsraw, phrase=argd['--phrase'])
         return xchat.EAT_ALL
 
     # Remove a custom pattern.
@@ -266,6 +1698,30 @@ def cmd_xhighlights(word, word_eol, userdata):
         remove_custom_pattern(cmdargs)
         return xchat.EAT_ALL
 
+    # Show/set the scopes for a custom pattern.
+    if argd['--scope']:
+        set_pattern_scopes(cmdargsraw)
+        return xchat.EAT_ALL
+
+    # Show/set contexts where nothing is highlighted.
+    if argd['--exclude']:
+        set_excluded(cmdargsraw)
+        return xchat.EAT_ALL
+
+    # Profile the next messages.
+    if argd['--profile']:
+        start_profile(cmdargsraw)
+        return xchat.EAT_ALL
+
+    # Print and/or reset stats.
+    if argd['--stats'] or argd['--reset']:
+        if argd['--stats']:
+            print_stats()
+        if argd['--reset']:
+            reset_stats()
+            print_status('Stats were reset.')
+        return xchat.EAT_ALL
+
     # Print custom patterns.
     if argd['--patterns']:
         print_custom_patterns()
@@ -337,6 +1793,17 @@ def color_code(color, suppresswarning=False):
     return COLORS['reset']['code']
 
 
+def color_join(fragments, sep=''):
+    """ Color a list of fragments, and join them.
+        Each fragment is either a plain string (not colored), or a tuple
+        of color_text() arguments: (color, text[, bold[, underline]]).
+    """
+    return sep.join(
+        fragment if isinstance(fragment, str) else color_text(*fragment)
+        for fragment in fragments
+    )
+
+
 def color_text(color=None, text=None, bold=False, underline=False):
     """ return a color coded word.
         Keyword Arguments:
@@ -349,21 +1816,11 @@ def color_text(color=None, text=None, bold=False, underline=False):
             underline:
                 Boolean. whether text is underlined or not.
     """
-
-    # normal color code
-    boldcode = ''
-    underlinecode = ''
-    normal = ''
-    code = color_code(color)
-    # initial text items (basic coloring)
-    strcodes = [code, text]
-    # Handle extra formatting (bold, underline)
-    if underline:
-        strcodes.insert(0, underlinecode)
-    if bold:
-        strcodes.insert(0, boldcode)
-
-    return '{}{}'.format(''.join(strcodes), normal)
+    try:
+        prefix, suffix = STYLES[(color, bool(bold), bool(underline))]
+    except KeyError:
+        prefix, suffix = get_style(color, bold=bold, underline=underline)
+    return ''.join((prefix, text, suffix))
 
 
 def get_cmd_rest(word):
@@ -378,6 +1835,159 @@ def get_cmd_rest(word):
     return ''
 
 
+def find_links(msg, _finditer=link_re.finditer):
+    """ Returns the link_re matches for links and emails in a message.
+        Bare domains (without a prefix like www. or http://) are only
+        links when their last label is a known top-level domain, which
+        is a single set lookup (see TLDS).
+        Matches for bare domains start at the last dot, they are only
+        good for finding the word they are in.
+    """
+    links = []
+    for linkmatch in _finditer(msg):
+        tld = linkmatch.group('tld')
+        if (tld is None) or (tld.lower() in TLDS):
+            links.append(linkmatch)
+    return links
+
+
+def find_slow_pattern(patterninfos, text):
+    """ Find the custom pattern that made a combined segment go over
+        CustomMatcher.budget for some text. Each pattern is probed with
+        prefixes of the text (see prefix_probes()), so only the slow one
+        takes long, and only about as long as the budget.
+        Returns (patterninfo, seconds) for the first one over the budget,
+        or the slowest one if none of them are slow by themselves.
+    """
+    slowest, slowtime = None, -1.0
+    for patterninfo in patterninfos:
+        elapsed, _ = probe_pattern(
+            patterninfo['pattern'],
+            prefix_probes(text),
+            phrase=patterninfo['phrase']
+        )
+        if elapsed > CustomMatcher.budget:
+            return patterninfo, elapsed
+        if elapsed > slowtime:
+            slowest, slowtime = patterninfo, elapsed
+    return slowest, slowtime
+
+
+def finish_profile(userdata):
+    """ Timer for HookProfiler, puts the normal message_filter() hooks
+        back, and then saves and prints the profile.
+    """
+    global PROFILER
+    profiler, PROFILER = PROFILER, None
+    hook_message_filter()
+    if profiler is not None:
+        save_profile(profiler)
+    # Only run once.
+    return False
+
+
+def first_chars(pattern):
+    """ Return a set of characters that a match for this compiled pattern
+        can start with, or None if any character might start it (or it
+        can match an empty word).
+        The set may include more characters than needed, it's only used
+        to rule out words that can't match.
+    """
+    if isinstance(pattern, LazyPattern):
+        return pattern.firstchars
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception as ex:
+        _log.error('Unable to parse pattern: {}\n{}'.format(
+            pattern.pattern,
+            ex
+        ))
+        return None
+    return first_chars_parsed(parsed)
+
+
+def first_chars_parsed(parsed):
+    """ Helper for first_chars(), works on an already parsed pattern. """
+    chars, nullable = first_chars_seq(parsed)
+    if nullable:
+        return None
+    return chars
+
+
+def first_chars_seq(items):
+    """ Helper for first_chars(), walks a parsed pattern sequence.
+        Returns (set_of_chars_or_None, can_match_empty).
+    """
+    chars = set()
+    for op, av in items:
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # Zero-width, doesn't consume anything.
+            continue
+        if op is sre_parse.LITERAL:
+            itemchars, nullable = {chr(av)}, False
+        elif op is sre_parse.IN:
+            itemchars, nullable = first_chars_in(av), False
+        elif op is sre_parse.SUBPATTERN:
+            itemchars, nullable = first_chars_seq(av[-1])
+        elif op is sre_parse.BRANCH:
+            itemchars, nullable = set(), False
+            for branch in av[1]:
+                branchchars, branchnull = first_chars_seq(branch)
+                if branchchars is None:
+                    return None, False
+                itemchars.update(branchchars)
+                nullable = nullable or branchnull
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            minrepeat, _, subitems = av
+            itemchars, nullable = first_chars_seq(subitems)
+            nullable = nullable or (minrepeat == 0)
+        else:
+            # ANY, NOT_LITERAL, CATEGORY, GROUPREF, etc.
+            return None, False
+
+        if itemchars is None:
+            return None, False
+        chars.update(itemchars)
+        if not nullable:
+            return with_case(chars), False
+    return with_case(chars), True
+
+
+def first_chars_in(items):
+    """ Helper for first_chars(), returns the characters in a parsed
+        character class, or None if there are too many to list.
+    """
+    chars = set()
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            chars.add(chr(av))
+        elif op is sre_parse.RANGE and (av[1] - av[0]) < 256:
+            chars.update(chr(c) for c in range(av[0], av[1] + 1))
+        else:
+            # NEGATE, CATEGORY, or a huge range.
+            return None
+    return chars
+
+
+def get_context_key(channel=None):
+    """ Return a key for the current context: (server id, channel name).
+        If a channel name is given it is used instead of the current one.
+    """
+    if channel is None:
+        channel = xchat.get_info('channel')
+    return (xchat.get_prefs('id'), channel)
+
+
+def get_user_nick(serverid):
+    """ Return the users own nick for a server connection (by server id).
+        It is cached until user_nick_event() says it may have changed.
+    """
+    nick = USERNICKS.get(serverid, None)
+    if nick is None:
+        nick = USERNICKS[serverid] = xchat.get_info('nick')
+    return nick
+
+
 def get_flag_args(word, arglist):
     """ Retrieves flag args from a command,
         returns a tuple with:
@@ -450,6 +2060,28 @@ def get_flag_args(word, arglist):
     return newword, arginfo
 
 
+def get_style(color, bold=False, underline=False):
+    """ Returns (prefix, suffix) codes for a color and style, from STYLES.
+        Colors that aren't in the table yet (mIRC numbers) are added.
+    """
+    key = (color, bool(bold), bool(underline))
+    try:
+        return STYLES[key]
+    except KeyError:
+        pass
+    code = color_code(color, suppresswarning=True)
+    if code is None:
+        # Prints the error, and returns the reset code.
+        return (color_code(color), COLORS['reset']['code'])
+    prefix = ''.join((
+        COLORS['bold']['code'] if bold else '',
+        COLORS['underline']['code'] if underline else '',
+        code,
+    ))
+    style = STYLES[key] = (prefix, COLORS['reset']['code'])
+    return style
+
+
 def get_stylecodes(userstyle):
     """ Parse and return the actual style codes from a users style string. """
     stylenames = parse_styles(userstyle)
@@ -475,57 +2107,34 @@ def emit_highlighted(*emitargs):
     EMITTING = True
     xchat.get_context().emit_print(*emitargs)
     EMITTING = False
-    return xchat.EAT_ALL
-
-
-def highlight_custom(word, patterninfo):
-    """ Highlight a custom word. """
-    template = patterninfo['template']
-
-    def colorize(s):
-        """ Wraps a word with the user styles and a reset. """
-        codes = patterninfo['stylecodes']
-        return '{}{}{}'.format(codes, s, Codes.normal)
-
-    rematch = patterninfo['pattern'].match(word)
-    if not rematch:
-        return word
-    matchgroupdict = rematch.groupdict()
-    if matchgroupdict:
-        # User is using named groups.
-        try:
-            newword = colorize(template.format(**matchgroupdict))
-        except Exception as ex:
-            errfmt = 'Unable to use .groupdict(): {}\n    with: {}\n    {}'
-            errmsg = errfmt.format(matchgroupdict, template, ex)
-            _log.error(errmsg)
-            return word
-        else:
-            return newword
+    return xchat.EAT_ALL
 
-    matchgroups = rematch.groups()
-    if matchgroups:
-        # User is using groups with the template.
-        try:
-            newword = colorize(template.format(*matchgroups))
-        except Exception as ex:
-            errfmt = 'Unable to use .groups(): {}\n    with: {}\n    {}'
-            _log.error(errfmt.format(matchgroups, template, ex))
-            return word
-        else:
-            # Return colorized groups.
-            return newword
 
-    # Simple single word highlight.
-    return colorize(template.format(word))
+def highlight_custom(word, patterninfo, rematch=None):
+    """ Highlight a custom word.
+        Arguments:
+            word        : The word to highlight.
+            patterninfo : The custom pattern info that matched.
+            rematch     : Match from CustomMatcher.match(), if there is
+                          one already. Otherwise the pattern is matched
+                          here.
+    """
+    if rematch is None:
+        rematch = patterninfo['pattern'].match(word)
+        if not rematch:
+            return word
+    # The template was compiled by build_renderer().
+    return patterninfo['render'](word, rematch)
 
 
-def highlight_word(s, style='link', ownmsg=False):
+def highlight_word(s, style='link', ownmsg=False, rules=None):
     """ Highlight a single word (string) in the prefferred style
         s:
             The word(string) to highlight.
         style:
             Type of word, either 'nick' or 'link'
+        rules:
+            RuleSnapshot with the styles, defaults to Codes.rules.
     """
     if not style:
         style = 'link'
@@ -535,12 +2144,13 @@ def highlight_word(s, style='link', ownmsg=False):
     colornormal = Codes.ownmsg if ownmsg else Codes.normal
     resetcode = Codes.normal + colornormal if ownmsg else colornormal
 
+    rules = rules or Codes.rules
     if style == 'link':
         # LINK Highlighting
-        stylecode = Codes.link
+        stylecode = rules.link
     elif style == 'nick':
         # NICK Highlighting
-        stylecode = Codes.nick
+        stylecode = rules.nick
     else:
         # Not implemented
         stylecode = Codes.normal
@@ -552,6 +2162,54 @@ def highlight_word(s, style='link', ownmsg=False):
     return formatted
 
 
+def hook_message_filter(wrap=None):
+    """ Hook message_filter() into every event in MESSAGE_EVENTS,
+        replacing the hooks that are already there.
+        If `wrap` is set, it is called with each hook function, and
+        returns the function to use instead (see HookProfiler.wrap()).
+    """
+    for eventname in MESSAGE_EVENTS:
+        eventhookname = 'message_filter.{}'.format(
+            eventname.lower().replace(' ', '')
+        )
+        oldhook = event_hooks.pop(eventhookname, None)
+        if oldhook is not None:
+            xchat.unhook(oldhook)
+        hookstats = HOOKSTATS.get(eventname, None)
+        if hookstats is None:
+            hookstats = HOOKSTATS[eventname] = HookStats(eventname)
+        hookfunc = timed_hook(message_filter, hookstats)
+        if wrap is not None:
+            hookfunc = wrap(hookfunc)
+        event_hooks[eventhookname] = xchat.hook_print(
+            eventname,
+            hookfunc,
+            userdata=EVENT_PIPELINES[eventname]
+        )
+        _log.debug('Hooked event: {}'.format(eventhookname))
+
+
+def load_tlds(filename):
+    """ Load top-level domains from a suffix list file (see TLDFILE),
+        with one domain per line and // comments.
+        Returns a frozenset of lower case labels, url_ext included.
+        If the file can't be read, only url_ext is used.
+    """
+    tlds = set(url_ext)
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and (not line.startswith('//')):
+                    tlds.add(line.lower())
+    except EnvironmentError as ex:
+        errmsg = 'Unable to load top-level domains, only using: {}'.format(
+            ', '.join(url_ext)
+        )
+        print_error(errmsg, exc=ex)
+    return frozenset(tlds)
+
+
 def load_user_color(stylename):
     """ Loads colors from preferences, or uses defaults on error. """
     stylename = stylename.lower().strip()
@@ -562,7 +2220,7 @@ def load_user_color(stylename):
             print_status('Default {} style will be used.'.format(stylename))
             try:
                 defaultcode = getattr(Codes, 'default{}'.format(stylename))
-                setattr(Codes, stylename, defaultcode)
+                swap_rules(Codes.rules.replace(**{stylename: defaultcode}))
             except Exception as ex:
                 print_error('Unable to set default style: '
                             '{}'.format(stylename),
@@ -571,118 +2229,370 @@ def load_user_color(stylename):
     return True
 
 
+def load_message_events():
+    """ Returns the print events to hook message_filter() into, from the
+        xhighlights_events preference (comma-separated event names).
+        All events in EVENT_PIPELINES are used if it isn't set.
+        Unknown events are skipped.
+    """
+    eventpref = pref_get('xhighlights_events')
+    if not eventpref:
+        return tuple(sorted(EVENT_PIPELINES))
+    events = []
+    for eventname in eventpref.split(','):
+        eventname = ' '.join(eventname.split())
+        if not eventname:
+            continue
+        # Event names are matched case-insensitively.
+        knownname = EVENT_NAMES.get(eventname.lower(), None)
+        if knownname is None:
+            print_error(
+                'Unknown event in xhighlights_events: {}'.format(eventname),
+                boldtext=eventname
+            )
+            continue
+        if knownname not in events:
+            events.append(knownname)
+    return tuple(events)
+
+
+def load_pattern_rules(rules):
+    """ Build the custom pattern list from plain rule dicts, as found in
+        CUSTOMFILE. Patterns are parsed here when the rule has no parse
+        info for them, and compiled all at once by the RuleSnapshot's
+        matcher (see LazyPattern).
+        Rules that haven't been through check_pattern_speed() yet (from
+        an older file, or edited by hand) are checked, and quarantined if
+        they are too slow.
+        Rules that fail are logged and skipped.
+    """
+    patterns = []
+    for rule in rules:
+        try:
+            parsed = LazyPattern.rule_parsed(rule)
+            pattern = LazyPattern(rule['pattern'], parsed=parsed)
+            patterninfo = build_patterninfo(
+                pattern,
+                rule['style'],
+                rule.get('template', '{}'),
+                quarantined=rule.get('quarantined', False),
+                scopes=[str(scope) for scope in rule.get('scopes', [])],
+                phrase=rule.get('phrase', False),
+                # An edited pattern is checked again.
+                checked=rule.get('checked', False) and (parsed is not None)
+            )
+        except (KeyError, TypeError, ValueError, re.error) as ex:
+            _log.error('Invalid custom pattern rule: {!r}\n{}'.format(
+                rule,
+                ex
+            ))
+            print_error('Skipping invalid custom pattern: {}'.format(rule))
+            continue
+        if not patterninfo['stylecodes']:
+            print_error(
+                'Skipping custom pattern with invalid style: {}'.format(
+                    rule['style']
+                ),
+                boldtext=rule['style']
+            )
+            continue
+        if not (patterninfo['checked'] or patterninfo['quarantined']):
+            try:
+                check_pattern_speed(pattern, phrase=patterninfo['phrase'])
+            except re.error as ex:
+                # Not parsed before, see LazyPattern.
+                _log.error('Invalid custom pattern rule: {!r}\n{}'.format(
+                    rule,
+                    ex
+                ))
+                print_error('Skipping invalid custom pattern: {}'.format(rule))
+                continue
+            except ValueError as ex:
+                patterninfo['quarantined'] = True
+                print_error(
+                    'Custom pattern is too slow, it was quarantined: '
+                    '{}'.format(patterninfo['patterntext']),
+                    exc=ex,
+                    boldtext=patterninfo['patterntext']
+                )
+            patterninfo['checked'] = True
+        patterns.append(patterninfo)
+    return patterns
+
+
 def load_user_patterns():
-    """ Load custom user patterns from the pickle file.
-        If it doesn't exist, then do nothing.
+    """ Load custom user patterns from CUSTOMFILE.
+        If it doesn't exist, old patterns are migrated from PICKLEFILE.
+        If neither exist, then do nothing.
+        A file that can't be loaded sets Codes.rules_readonly, so it is
+        never overwritten by save_user_patterns().
     """
+    Codes.rules_readonly = False
     if not os.path.isfile(CUSTOMFILE):
-        Codes.custom = []
+        if os.path.isfile(PICKLEFILE):
+            return migrate_user_patterns()
+        swap_rules(Codes.rules.replace(custom=()))
         return False
 
     try:
-        with open(CUSTOMFILE, 'rb') as f:
-            data = f.read()
-            if not data:
-                return False
-            data = pickle.loads(data)
-    except EnvironmentError as ex:
+        with open(CUSTOMFILE, 'r') as f:
+            data = json.load(f)
+    except (EnvironmentError, ValueError) as ex:
         errmsg = 'Unable to load custom patterns!'
         print_error(errmsg, exc=ex)
+        Codes.rules_readonly = True
+        return False
+    version = data.get('version', None) if isinstance(data, dict) else None
+    if not isinstance(version, int):
+        print_error('Invalid custom pattern file: {}'.format(CUSTOMFILE))
+        Codes.rules_readonly = True
+        return False
+    if version > RULES_VERSION:
+        print_error(
+            'Custom pattern file is from a newer version: {}'.format(
+                CUSTOMFILE
+            ),
+            boldtext=CUSTOMFILE
+        )
+        Codes.rules_readonly = True
+        return False
+    rules = data.get('patterns', [])
+    swap_rules(Codes.rules.replace(custom=load_pattern_rules(rules)))
+    if any(
+            not (rule.get('checked', False) and LazyPattern.rule_parsed(rule))
+            for rule in rules
+            if isinstance(rule, dict)):
+        # Save the check results and parse info, so they aren't done
+        # every time.
+        save_user_patterns()
+    return True
+
+
+def migrate_user_patterns():
+    """ Convert the old pickled custom patterns (PICKLEFILE) into the
+        CUSTOMFILE format. The old file is left alone.
+        Returns True on success, False on failure.
+    """
+    try:
+        with open(PICKLEFILE, 'rb') as f:
+            data = f.read()
+        olddata = pickle.loads(data) if data else []
+    except Exception as ex:
+        errmsg = 'Unable to load old custom patterns!'
+        print_error(errmsg, exc=ex)
         return False
-    Codes.custom = data[:]
+    rules = []
+    for patterninfo in olddata:
+        try:
+            rules.append(pattern_rule(patterninfo))
+        except (KeyError, TypeError) as ex:
+            _log.error('Invalid old custom pattern: {!r}\n{}'.format(
+                patterninfo,
+                ex
+            ))
+    swap_rules(Codes.rules.replace(custom=load_pattern_rules(rules)))
+    print_status('Migrating custom patterns from: {}'.format(PICKLEFILE))
+    return save_user_patterns()
+
+
+def matcher_patterns(custom):
+    """ Returns the custom patterns for a RuleSnapshot's matcher, in the
+        order they should be tried. Quarantined patterns are left out.
+    """
+    patterns = [p for p in custom if not p['quarantined']]
+    if Codes.reorder:
+        patterns = reorder_patterns(patterns)
+    return patterns
 
 
-def message_filter(word, word_eol, userdata):
+def message_filter(word, word_eol, pipeline):
     """ Filter all messages coming into the chat window.
         Arguments:
             word:
-                List of data[nick, message]
+                List of data[nick, message, ...], the message index
+                depends on the event.
             word_eol:
                 Same as word except [nick message, message]
-            userdata:
-                The event this message came from (used to emit_print())
+            pipeline:
+                The EventPipeline for the event this message came from.
     """
     if EMITTING:
-        _log.debug('Skipping own emit type: {}'.format(userdata))
+        _log.debug('Skipping own emit type: %s', pipeline.event)
         return xchat.EAT_NONE
-    _log.debug('Filtering message type: {}'.format(userdata))
-
-    # Get list of nicks.
-    userslist = [u.nick for u in xchat.get_list('users')]
-
-    # Get nick for message, and current users nick
-    msgnick = word[0]
+    _log.debug('Filtering message type: %s', pipeline.event)
+
+    # Get rules and nick matcher for this channel.
+    # The snapshot is used for the whole message, even if it is swapped.
+    rules = Codes.rules
+    ctxkey = get_context_key()
+    ruleset = CONTEXTRULES.get(ctxkey, rules)
+    if ruleset.excluded:
+        return xchat.EAT_NONE
+    # Check for floods, they get a cheaper mode.
+    mode = 'normal'
+    if FloodMonitor.threshold:
+        floodmonitor = FLOODS.get(ctxkey, None)
+        if floodmonitor is None:
+            floodmonitor = FLOODS[ctxkey] = FloodMonitor()
+        mode = floodmonitor.check(time.monotonic())
+        if mode == 'pass':
+            return xchat.EAT_NONE
+    if mode == 'links':
+        matcher = LINKS_ONLY
+        nickmatcher = None
+    else:
+        matcher = ruleset.matcher
+        # (No nicks for highlights or dialogs, see EVENT_PIPELINES)
+        nickmatcher = NICKS.get(ctxkey) if pipeline.nicks else None
 
     # The actual message.
-    msg = word[1]
-    # Words in the actual message.
-    msgwords = msg.split(' ')
+    msgindex = pipeline.msgindex
+    msg = word[msgindex]
     # Flag for when messsages are modified
     # (otherwise we don't emit or EAT anything.)
     highlighted = False
 
-    if userdata and ('Msg Hilight' in userdata):
-        normalmsg = False
-    else:
-        normalmsg = True
+    # Skip messages that can't have anything to highlight.
+    if not message_has_candidates(msg, nickmatcher, matcher=matcher):
+        Stats.skipped += 1
+        return xchat.EAT_NONE
+    Stats.processed += 1
 
-    usernick = (xchat.get_context()).get_info('nick')
+    usernick = get_user_nick(ctxkey[0])
     msgnick = remove_mirc_color(word[0])
     # Determine if this is the users own message
     # (changes highlight_word() settings)
     userownmsg = (usernick == msgnick)
 
-    for i, eachword in enumerate(msgwords):
-        # Word is users own nick name?
-        ownnick = (eachword == usernick) or (eachword[:-1] == usernick)
-        # Word is any user name?
-        nickword = (eachword in userslist) or (eachword[:-1] in userslist)
-
-        # Custom patterns.
-        for custompat in Codes.custom:
-            if custompat['pattern'].match(eachword):
-                msgwords[i] = highlight_custom(eachword, custompat)
-                # Set eachword to the newly highlighted custom pattern
-                # If it was turned into a link, it will be highlighted.
-                eachword = msgwords[i]
-                highlighted = True
-                break
-
-        # Link highlighting
-        linkmatch = link_re.search(eachword)
-        if linkmatch is not None:
-            # Highlight it
-            msgwords[i] = highlight_word(
-                eachword,
-                'link',
-                ownmsg=userownmsg
-            )
-            highlighted = True
-
-        # Nick highlighting
+    # Repeated messages may already be rendered, with the custom patterns
+    # that matched (their hits are counted again).
+    cachekey = (
+        ctxkey,
+        pipeline.event,
+        msg,
+        userownmsg,
+        usernick,
+        rules.version,
+        None if nickmatcher is None else nickmatcher.version,
+        mode,
+    )
+    cached = RENDERCACHE.get(cachekey, None)
+    if cached is not None:
+        rendered, matched = cached
+        for patterninfo in matched:
+            patterninfo['stats'].hits += 1
+    else:
+        # Find everything to highlight, in one pass over the message.
         # (Don't highlight your own nick, thats for Channel Msg Hilight)
-        elif (normalmsg and (not ownnick)) and nickword:
-            msgwords[i] = highlight_word(
-                eachword,
-                'nick',
-                ownmsg=userownmsg
+        spans = tokenize_message(
+            msg,
+            nickmatcher=nickmatcher,
+            usernick=usernick,
+            matcher=matcher
+        )
+        rendered = None
+        if spans:
+            rendered = render_spans(
+                msg,
+                spans,
+                ownmsg=userownmsg,
+                rules=rules
             )
-            highlighted = True
+        matched = tuple(
+            data[0] for _, _, kind, data in spans if kind == 'custom'
+        )
+        RENDERCACHE.set(cachekey, (rendered, matched))
 
-    # Replace old message.
-    word[1] = ' '.join(msgwords)
+    if rendered is not None:
+        # Replace old message.
+        word[msgindex] = rendered
+        highlighted = True
 
     # Print to the chat window.
     if highlighted:
-        _log.debug('Highlighted: {}'.format(' '.join(word)))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('Highlighted: %s', ' '.join(word))
         # Emit modified message (with highlighting)
-        # (userdata=Event Name, word = Modifed Message)
-        return emit_highlighted(*([userdata] + word))
+        # (event name, word = Modifed Message)
+        return emit_highlighted(*([pipeline.event] + word))
     else:
         # Nothing was done to this message
         return xchat.EAT_NONE
 
 
+def message_has_candidates(msg, nickmatcher=None, matcher=None):
+    """ Cheap pre-screen for message_filter().
+        Returns False when a message can't possibly contain a link,
+        custom pattern, or nick. Returns True when it might.
+        If nickmatcher is None, nicks are not checked.
+        The CustomMatcher defaults to Codes.rules.matcher.
+    """
+    for linkchar in link_chars:
+        if linkchar in msg:
+            return True
+    if (matcher or Codes.rules.matcher).has_candidates(msg):
+        return True
+    if nickmatcher is None:
+        return False
+    return bool(nickmatcher.find(msg, limit=1))
+
+
+def is_nick_char(c):
+    """ Returns True if this character continues a word inside a nick.
+        (used to find the end of a nick mention)
+    """
+    return bool(c) and (c.isalnum() or (c in nick_word_chars))
+
+
+def nick_event(word, word_eol, userdata):
+    """ Keep the NickIndex current when users join/part/quit/change nicks.
+        Arguments:
+            word:
+                Event arguments, layout depends on the event.
+            word_eol:
+                Not used.
+            userdata:
+                The event name.
+    """
+    if userdata == 'Join':
+        NICKS.add(get_context_key(), word[0])
+    elif userdata in ('Part', 'Part with Reason', 'Quit'):
+        NICKS.discard(get_context_key(), word[0])
+    elif userdata == 'Kick':
+        NICKS.discard(get_context_key(), word[1])
+    elif userdata == 'Change Nick':
+        NICKS.rename(get_context_key(), word[0], word[1])
+    else:
+        # You Join/You Part/You Kicked, the user list is about to change.
+        NICKS.invalidate(get_context_key())
+    return xchat.EAT_NONE
+
+
+def nick_names_end(word, word_eol, userdata):
+    """ The NAMES list for a channel has been received (366),
+        rebuild that channel's nick set on the next message.
+        word[3] is the channel name.
+    """
+    if len(word) > 3:
+        NICKS.invalidate(get_context_key(channel=word[3]))
+    return xchat.EAT_NONE
+
+
+def parse_scope(scope):
+    """ Parse a scope string into (network glob, channel glob).
+        Scopes look like: network/channel, network, or #channel.
+        Globs are matched case-insensitively, see scope_matches().
+    """
+    scope = scope.lower()
+    if '/' in scope:
+        network, channel = scope.split('/', 1)
+    elif scope[:1] in '#&!+':
+        network, channel = '*', scope
+    else:
+        network, channel = scope, '*'
+    return (network or '*', channel or '*')
+
+
 def parse_styles(txt):
     """ Parses comma - separated styles. """
     return [s.strip() for s in txt.split(',')]
@@ -691,102 +2601,78 @@ def parse_styles(txt):
 def pref_get(opt):
     """ Retrieves an XHighlights preference.
         Does not depend on XChats preferences file anymore.
-        It will read from the global CONFIGFILE.
+        It will read from the global CONFIGFILE (through PREFS).
     """
-    # Load prefs data.
-    if os.path.isfile(CONFIGFILE):
-        try:
-            with open(CONFIGFILE, 'r') as fread:
-                allprefs = fread.readlines()
-        except (IOError, OSError) as ex:
-            print_error('Unable to open config file: {}'.format(CONFIGFILE),
-                        exc=ex,
-                        boldtext=CONFIGFILE)
-            return False
-    else:
-        # No prefs file.
-        allprefs = []
-    existingopt = None
-    for line in allprefs:
-        if line.startswith(opt):
-            # Found the line, retrieve its whole content.
-            existingopt = line
-            break
+    return PREFS.get(opt)
 
-    # No option found.
-    if not existingopt:
-        return None
 
-    # Parse option.
-    if '=' in existingopt:
-        val = existingopt.strip('\n').split('=')[1].strip()
-        return val
-    else:
-        # Bad config
-        return None
+def pref_get_int(opt, default=0):
+    """ Retrieves an XHighlights preference as an int.
+        Returns the default if it isn't set, or isn't a valid number.
+    """
+    val = pref_get(opt)
+    if not val:
+        return default
+    try:
+        return int(val)
+    except ValueError:
+        print_error(
+            'Invalid number for {}: {}'.format(opt, val),
+            boldtext=val
+        )
+        return default
 
 
 def pref_set(opt, val):
     """ Sets an XHighlights preference.
         Does not depend on the XChat preferences file.
-        Will store in global CONFIGFILE.
+        Will store in global CONFIGFILE (through PREFS).
+        Inside a PREFS.batch(), the file is written once at the end.
     """
+    return PREFS.set(opt, val)
 
-    # Load prefs data.
-    if os.path.isfile(CONFIGFILE):
-        try:
-            with open(CONFIGFILE, 'r') as fread:
-                allprefs = fread.readlines()
-        except (IOError, OSError) as ex:
-            print_error('Unable to open config file: {}'.format(CONFIGFILE),
-                        exc=ex,
-                        boldtext=CONFIGFILE)
-            return False
-    else:
-        # No config file yet.
-        allprefs = []
-
-    # new options line for xchat.conf.
-    optline = '{} = {}'.format(opt, str(val))
-
-    # Search preferences for this option.
-    existingopt = None
-    for line in allprefs:
-        if line.startswith(opt):
-            # Found the line, retrieve its whole content.
-            existingopt = line
-            break
-
-    # Existing pref.
-    if existingopt:
-        if existingopt == optline:
-            # Pref already set.
-            return True
-
-        allprefs[allprefs.index(existingopt)] = optline
-    # New pref.
-    else:
-        allprefs.append(optline)
-
-    # Remove blank lines..
-    while '' in allprefs:
-        allprefs.remove('')
-    while '\n' in allprefs:
-        allprefs.remove('\n')
 
-    # Write preferences.
-    try:
-        with open(CONFIGFILE, 'w') as fwrite:
-            fwrite.writelines(allprefs)
-            fwrite.write('\n')
-            return True
-    except (IOError, OSError) as ex:
-        print_error(
-            'Unable to write to config file: {}'.format(CONFIGFILE),
-            exc=ex,
-            boldtext=CONFIGFILE
-        )
-        return False
+def pattern_rule(patterninfo):
+    """ Return the plain rule dict for a custom pattern, for CUSTOMFILE.
+        The source text is kept, and what LazyPattern needs from parsing
+        it, so it doesn't have to be parsed again when it is loaded.
+    """
+    rule = {
+        'pattern': patterninfo['patterntext'],
+        'style': patterninfo['style'],
+        'template': patterninfo['template'],
+    }
+    pattern = patterninfo.get('pattern', None)
+    if (pattern is not None) and ('firstchars' in patterninfo):
+        firstchars = patterninfo['firstchars']
+        rule['parsed'] = {
+            'crc32': LazyPattern.checksum(pattern.pattern),
+            'flags': pattern.flags,
+            'groups': pattern.groups,
+            'groupindex': dict(pattern.groupindex),
+            'firstchars': (
+                None if firstchars is None else ''.join(sorted(firstchars))
+            ),
+        }
+    if patterninfo.get('quarantined', False):
+        rule['quarantined'] = True
+    if patterninfo.get('scopes', None):
+        rule['scopes'] = patterninfo['scopes']
+    if patterninfo.get('phrase', False):
+        rule['phrase'] = True
+    if patterninfo.get('checked', False):
+        rule['checked'] = True
+    return rule
+
+
+def prefix_probes(text):
+    """ Yields probe strings for probe_pattern() from text that was slow
+        to match: longer and longer prefixes of it, with and without its
+        last character (which is often the one that doesn't match).
+    """
+    for length in probe_lengths(len(text)):
+        yield text[:length]
+        yield ''.join((text[:length - 1], text[-1]))
 
 
 def print_currentstyles(link=True, nick=True):
@@ -800,27 +2686,53 @@ def print_currentstyles(link=True, nick=True):
     else:
         header = 'Current link style:' if link else 'Current nick style:'
     print('\n{}'.format(header))
+    rules = Codes.rules
     if link:
-        print('    {}Link'.format(Codes.link))
+        print('    {}Link'.format(rules.link))
     if nick:
-        print('    {}Nick'.format(Codes.nick))
+        print('    {}Nick'.format(rules.nick))
 
 
 def print_custom_patterns():
     """ Print all of the custom patterns to the window. """
-    if not Codes.custom:
+    rules = Codes.rules
+    if not rules.custom:
         print_error('No custom patterns have been set. Set them with --add.')
         return None
 
     print_status('Current custom patterns:')
-    patfmt = '{index}: {txt} {style} {template}'
-    for i, custompat in enumerate(Codes.custom):
-        patstr = patfmt.format(
-            index=color_text('blue', str(i), bold=True),
-            txt=color_text('green', custompat['patterntext']),
-            style=custompat['style'],
-            template=color_text('red', custompat['template']))
-        print(patstr)
+    for i, custompat in enumerate(rules.custom):
+        stats = custompat['stats']
+        if stats.evals:
+            evaltime = '{:0.1f}us'.format(
+                (stats.evaltime / stats.evals) * 1000000
+            )
+        else:
+            evaltime = '-'
+        counters = '(hits: {}, time: {})'.format(stats.hits, evaltime)
+        fragments = [
+            '{}:'.format(color_text('blue', str(i), bold=True)),
+            ('green', custompat['patterntext']),
+            custompat['style'],
+            ('red', custompat['template']),
+            ('grey', counters),
+        ]
+        if custompat['phrase']:
+            fragments.append(('grey', '[phrase]'))
+        if custompat['scopes']:
+            fragments.append(
+                ('grey', 'in: {}'.format(' '.join(custompat['scopes'])))
+            )
+        if custompat['quarantined']:
+            fragments.append(('red', '[quarantined, too slow]', True))
+        print(color_join(fragments, sep=' '))
+    if Codes.reorder:
+        indexes = {id(p): i for i, p in enumerate(rules.custom)}
+        order = ', '.join(
+            str(indexes[id(patterninfo)])
+            for patterninfo in rules.matcher.patterns
+        )
+        print(color_text('grey', 'Match order: {}'.format(order)))
 
 
 def print_error(msg, exc=None, boldtext=None):
@@ -910,15 +2822,98 @@ def print_help(cmdname):
         print(color_text('grey', line))
 
 
+def print_stats():
+    """ Print hook latency stats, and other message_filter() counters. """
+    print_status('Hook stats (latency in microseconds):')
+    headerfmt = '    {:<24} {:>8} {:>8} {:>8} {:>7} {:>7} {:>7} {:>9}'
+    print(color_text('blue', headerfmt.format(
+        'Event', 'Calls', 'Emits', 'Skips', 'p50', 'p95', 'p99', 'Max'
+    )))
+    linefmt = '    {:<24} {:>8} {:>8} {:>8} {:>7} {:>7} {:>7} {:>9.0f}'
+    for name in sorted(HOOKSTATS):
+        hookstats = HOOKSTATS[name]
+        print(linefmt.format(
+            name,
+            hookstats.calls,
+            hookstats.emits,
+            hookstats.skips,
+            hookstats.percentile(50),
+            hookstats.percentile(95),
+            hookstats.percentile(99),
+            hookstats.maxtime * 1000000
+        ))
+
+    statlines = [
+        '   Nick Index Rebuilds: {}'.format(NICKS.rebuilds),
+        '      Messages Skipped: {}'.format(Stats.skipped),
+        '    Messages Processed: {}'.format(Stats.processed),
+        '    Skipped Percentage: {:0.1f}%'.format(Stats.skipped_percent()),
+        '     Render Cache Size: {}/{}'.format(
+            len(RENDERCACHE),
+            RENDERCACHE.maxsize
+        ),
+        '     Render Cache Hits: {} ({:0.1f}%)'.format(
+            RENDERCACHE.hits,
+            RENDERCACHE.hit_percent()
+        ),
+        '   Render Cache Misses: {}'.format(RENDERCACHE.misses),
+    ]
+    print('')
+    for line in statlines:
+        print(color_text('grey', line))
+
+    if not FloodMonitor.threshold:
+        return None
+    print('')
+    print_status('Flood modes (over {} lines/sec: {}):'.format(
+        FloodMonitor.threshold,
+        FloodMonitor.floodmode
+    ))
+    now = time.monotonic()
+    floodlines = []
+    for (serverid, channel), monitor in sorted(
+            FLOODS.items(), key=lambda item: str(item[0])):
+        if not monitor.floods:
+            continue
+        modetimes = monitor.mode_times(now)
+        floodlines.append(
+            '    {} ({}): {} for {:0.0f}s, floods: {}, {}'.format(
+                channel,
+                serverid,
+                monitor.mode,
+                now - monitor.modestart,
+                monitor.floods,
+                ', '.join(
+                    '{}: {:0.0f}s'.format(mode, modetimes[mode])
+                    for mode in FloodMonitor.modes
+                )
+            )
+        )
+    if not floodlines:
+        floodlines.append('    No floods in {} channels.'.format(len(FLOODS)))
+    for line in floodlines:
+        print(color_text('grey', line))
+
+
 def print_status(s):
     """ Prints a formatted status message. """
 
     print('\n{}\n'.format(color_text('green', s)))
 
 
-# Helper function for remove_mirc_color (for preloading sub function)
-mirc_color_regex = re.escape('\x03') + r'(?:(\d{1,2})(?:,(\d{1,2}))?)?'
+# Helper for remove_mirc_color (for preloading sub function).
+# IRC formatting codes: color (\x03 with optional fg,bg), hex color
+# (\x04 with optional rrggbb,rrggbb), bold, hidden, reset, monospace,
+# reverse, italic, strikethrough, and underline.
+mirc_color_regex = (
+    r'\x03(?:\d{1,2}(?:,\d{1,2})?)?'
+    r'|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?'
+    r'|\x08<?'
+    r'|[\x02\x0f\x11\x16\x1d\x1e\x1f]'
+)
 mirc_sub_pattern = re.compile(mirc_color_regex).sub
+# Stripped short strings (like nicks), see remove_mirc_color().
+mirc_strip_cache = {}
 
 
 def print_styles():
@@ -933,6 +2928,143 @@ def print_styles():
     print('')
 
 
+def probe_lengths(limit):
+    """ Yields string lengths for probes, up to limit.
+        They go up by one at first, where exponential backtracking shows
+        up, and then by a quarter each time.
+    """
+    length = 1
+    while length <= limit:
+        yield length
+        if length < 32:
+            length += 1
+        else:
+            length += length // 4
+
+
+def probe_pattern(pattern, probes, phrase=False):
+    """ Time a custom pattern against probe strings that get longer as
+        they go (see probe_strings() and prefix_probes()).
+        Stops at the first one that goes over CustomMatcher.budget, so
+        a pattern with catastrophic backtracking only stalls for about
+        that long, instead of for minutes.
+        Phrase patterns are searched for, word patterns are matched.
+        Returns (seconds, probe) for the slowest probe, or (0.0, None).
+    """
+    match = pattern.search if phrase else pattern.match
+    # Compile a LazyPattern first, so that isn't timed.
+    match('')
+    clock = time.perf_counter
+    budget = CustomMatcher.budget
+    slowest = (0.0, None)
+    for probe in probes:
+        start = clock()
+        match(probe)
+        elapsed = clock() - start
+        if elapsed > slowest[0]:
+            slowest = (elapsed, probe)
+            if elapsed > budget:
+                break
+    return slowest
+
+
+def probe_strings(pattern, limit=None):
+    """ Yields crafted strings for probe_pattern(), getting longer, up to
+        limit (MAX_WORD_LENGTH by default).
+        Each one repeats some literal text from the pattern (or a few
+        common characters), with and without a character at the end that
+        won't match. That is what makes backtracking patterns slow.
+    """
+    if limit is None:
+        limit = MAX_WORD_LENGTH
+    units = {'a', 'A', '0', ' ', '.'}
+    try:
+        probe_units(sre_parse.parse(pattern.pattern, pattern.flags), units)
+    except Exception as ex:
+        _log.error('Unable to parse pattern: {}\n{}'.format(
+            pattern.pattern,
+            ex
+        ))
+    units = sorted(units, key=lambda s: (len(s), s))[:16]
+    for length in probe_lengths(limit):
+        for unit in units:
+            text = (unit * ((length // len(unit)) + 1))[:length]
+            yield text
+            yield ''.join((text, '\x00'))
+
+
+def probe_units(items, units):
+    """ Helper for probe_strings(), adds the literal text (and the single
+        characters) in a parsed pattern to a set of units.
+    """
+    run = []
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            units.add(chr(av))
+            continue
+        if len(run) > 1:
+            units.add(''.join(run))
+        run = []
+        if op is sre_parse.SUBPATTERN:
+            probe_units(av[-1], units)
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                probe_units(branch, units)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            probe_units(av[2], units)
+        elif op is sre_parse.IN:
+            for inop, inav in av:
+                if inop is sre_parse.LITERAL:
+                    units.add(chr(inav))
+                elif inop is sre_parse.RANGE:
+                    units.add(chr(inav[0]))
+    if len(run) > 1:
+        units.add(''.join(run))
+
+
+def render_spans(msg, spans, ownmsg=False, rules=None):
+    """ Rebuild a message, highlighting the spans from tokenize_message().
+        Arguments:
+            msg     : The original message.
+            spans   : Sorted list of (start, end, kind, data).
+            ownmsg  : Whether this is the users own message.
+                      (changes highlight_word() settings)
+            rules   : RuleSnapshot with the styles, or Codes.rules.
+    """
+    rules = rules or Codes.rules
+    parts = []
+    last = 0
+    for start, end, kind, data in spans:
+        parts.append(msg[last:start])
+        text = msg[start:end]
+        if kind == 'custom':
+            patterninfo, rematch, nickword = data
+            text = highlight_custom(text, patterninfo, rematch)
+            # If it was turned into a link, it will be highlighted.
+            if find_links(text):
+                text = highlight_word(
+                    text, 'link', ownmsg=ownmsg, rules=rules
+                )
+            elif nickword:
+                text = highlight_word(
+                    text, 'nick', ownmsg=ownmsg, rules=rules
+                )
+        elif kind == 'nick':
+            text = highlight_word(
+                text, 'nick', ownmsg=ownmsg, rules=rules
+            )
+        else:
+            # link, domain, or email.
+            text = highlight_word(
+                text, 'link', ownmsg=ownmsg, rules=rules
+            )
+        parts.append(text)
+        last = end
+    parts.append(msg[last:])
+    return ''.join(parts)
+
+
 def remove_custom_pattern(index):
     """ Remove a custom pattern from the list, by index. """
 
@@ -942,12 +3074,14 @@ def remove_custom_pattern(index):
         errmsg = 'Invalid index for custom pattern: {}'.format(index)
         print_error(errmsg, boldtext=str(index))
         return None
+    custom = list(Codes.rules.custom)
     try:
-        item = Codes.custom.pop(index)
+        item = custom.pop(index)
     except IndexError as exindex:
         errmsg = 'Error removing custom pattern: {}'.format(index)
         print_error(errmsg, exc=exindex, boldtext=str(index))
         return None
+    swap_rules(Codes.rules.replace(custom=custom))
     itempat = item['patterntext']
     print_status('Removed: {}'.format(itempat))
     if save_user_patterns():
@@ -956,31 +3090,255 @@ def remove_custom_pattern(index):
     return None
 
 
-def remove_mirc_color(text, _resubpat=mirc_sub_pattern):
-    """ Removes color code from text
-        (idea borrowed from nosklos clutterless.py)
-        Sub pattern is preloaded on function definition,
-        like nosklos(but more readable i think)
+def remove_mirc_color(
+        text, _resubpat=mirc_sub_pattern, _cache=mirc_strip_cache,
+        _cachelen=32, _cachemax=4096):
+    """ Removes IRC formatting codes (colors and styles) from text,
+        with a single regex pass.
+        Short strings, like nicks, are memoized.
+    """
+    if len(text) > _cachelen:
+        return _resubpat('', text)
+    stripped = _cache.get(text, None)
+    if stripped is None:
+        if len(_cache) >= _cachemax:
+            _cache.clear()
+        stripped = _cache[text] = _resubpat('', text)
+    return stripped
+
+
+def quarantine_slow_patterns():
+    """ Handle the segments in Watchdog.overbudget.
+        The slow pattern is quarantined (not used anymore), and the user
+        is told about it. For a combined segment, the slow pattern is
+        found with find_slow_pattern().
+        Changed patterns are copied into a new RuleSnapshot, and saved.
+    """
+    # Slow patterns, by id().
+    slow = {}
+    overbudget, Watchdog.overbudget = Watchdog.overbudget, []
+    for segment, elapsed, text in overbudget:
+        pattern, names, patterninfo = segment
+        if names is not None:
+            patterninfo, elapsed = find_slow_pattern(
+                [info for _, info in names.values()],
+                text
+            )
+        if patterninfo['quarantined'] or (id(patterninfo) in slow):
+            continue
+        slow[id(patterninfo)] = patterninfo
+        print_error(
+            'Custom pattern took {:0.0f}ms for {} chars, '
+            'it was quarantined: {}'.format(
+                elapsed * 1000,
+                len(text),
+                patterninfo['patterntext'],
+            ),
+            boldtext=patterninfo['patterntext']
+        )
+    if not slow:
+        return None
+    custom = [
+        dict(patterninfo, quarantined=True)
+        if id(patterninfo) in slow else patterninfo
+        for patterninfo in Codes.rules.custom
+    ]
+    swap_rules(Codes.rules.replace(custom=custom))
+    save_user_patterns()
+
+
+def reorder_patterns(patterns):
+    """ Returns custom patterns ordered by hit count (most hits first),
+        wherever that can't change which pattern matches a word.
+        Patterns that overlap (could start with the same character, see
+        first_chars()) keep their original order, which is their priority.
     """
-    return _resubpat('', text)
+    # Patterns that must come before each pattern, as a graph.
+    after = [[] for _ in patterns]
+    depcount = [0] * len(patterns)
+    # Last pattern that can start with each char, and the last pattern
+    # that can start with anything.
+    lastchar = {}
+    lastany = None
+    for i, patterninfo in enumerate(patterns):
+        chars = patterninfo['firstchars']
+        if chars is None:
+            deps = set(lastchar.values())
+            lastchar = {}
+        else:
+            deps = {lastchar[c] for c in chars if c in lastchar}
+            lastchar.update((c, i) for c in chars)
+        if lastany is not None:
+            deps.add(lastany)
+        if chars is None:
+            lastany = i
+        for dep in deps:
+            after[dep].append(i)
+        depcount[i] = len(deps)
+
+    ready = [
+        (-patterns[i]['stats'].hits, i)
+        for i, deps in enumerate(depcount)
+        if not deps
+    ]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        ordered.append(patterns[i])
+        for nexti in after[i]:
+            depcount[nexti] -= 1
+            if not depcount[nexti]:
+                heapq.heappush(
+                    ready,
+                    (-patterns[nexti]['stats'].hits, nexti)
+                )
+    return ordered
+
+
+def reorder_timer(userdata):
+    """ Timer for Codes.reorder, swaps in a reordered custom matcher when
+        the pattern hit counts have changed the best order.
+    """
+    rules = Codes.rules
+    ordered = matcher_patterns(rules.custom)
+    if any(a is not b for a, b in zip(ordered, rules.matcher.patterns)):
+        swap_rules(rules.replace(matcher=CustomMatcher(ordered)))
+    return True
+
+
+def reset_stats():
+    """ Reset hook stats and message_filter() counters. """
+    for hookstats in HOOKSTATS.values():
+        hookstats.reset()
+    FLOODS.clear()
+    for patterninfo in Codes.rules.custom:
+        patterninfo['stats'].reset()
+    Stats.reset()
+    NICKS.rebuilds = 0
+    RENDERCACHE.hits = 0
+    RENDERCACHE.misses = 0
 
 
 def save_user_patterns():
-    """ Save CUSTOMPATS to a pickle file.
+    """ Save the custom patterns to CUSTOMFILE.
         Returns True on success, False on failure.
         Prints status/error messages.
+        Nothing is saved while Codes.rules_readonly is set (the file
+        couldn't be loaded, see load_user_patterns()).
     """
+    if Codes.rules_readonly:
+        print_error(
+            'Custom patterns were not saved, the file could not be loaded '
+            '(fix or move it, and reload the plugin): {}'.format(CUSTOMFILE),
+            boldtext=CUSTOMFILE
+        )
+        return False
+    custom = Codes.rules.custom
+    data = {
+        'version': RULES_VERSION,
+        'patterns': [pattern_rule(p) for p in custom],
+    }
     try:
-        with open(CUSTOMFILE, 'wb') as f:
-            pickle.dump(Codes.custom, f)
-    except EnvironmentError as expickle:
+        write_atomic(
+            CUSTOMFILE,
+            '{}\n'.format(json.dumps(data, indent=4, sort_keys=True))
+        )
+    except EnvironmentError as exsave:
         errmsg = 'Unable to save custom patterns!'
-        print_error(errmsg, exc=expickle)
+        print_error(errmsg, exc=exsave)
         return False
-    print_status('Custom patterns were saved. [{}]'.format(len(Codes.custom)))
+    print_status('Custom patterns were saved. [{}]'.format(len(custom)))
     return True
 
 
+def save_profile(profiler, limit=20):
+    """ Save a HookProfiler's stats to a pstats file next to CONFIGFILE,
+        and print the top entries by cumulative time.
+        Returns the file name on success, or None on failure.
+    """
+    filename = os.path.join(
+        CWD,
+        'xhighlights.{}.pstats'.format(time.strftime('%Y%m%d-%H%M%S'))
+    )
+    try:
+        profiler.profile.dump_stats(filename)
+    except EnvironmentError as ex:
+        print_error('Unable to save profile!', exc=ex)
+        return None
+    print_status('Profiled {} messages, saved to: {}'.format(
+        profiler.calls,
+        filename
+    ))
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler.profile, stream=stream)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+    for line in stream.getvalue().splitlines():
+        if line.strip():
+            print(line)
+    return filename
+
+
+def scope_matches(scopes, network, channel):
+    """ Returns True if any scope string matches this network/channel. """
+    network = network.lower()
+    channel = channel.lower()
+    for scope in scopes:
+        netglob, changlob = parse_scope(scope)
+        if fnmatchcase(network, netglob) and fnmatchcase(channel, changlob):
+            return True
+    return False
+
+
+def set_excluded(cmdargs):
+    """ Show or set the scopes where nothing is highlighted (--exclude).
+        Expects: '[scope...]', or 'none' to clear them.
+    """
+    scopes = cmdargs.split()
+    if not scopes:
+        if not CONTEXTRULES.excluded:
+            print_status('Highlighting is not excluded anywhere.')
+        else:
+            print_status('Highlighting is excluded in: {}'.format(
+                ' '.join(CONTEXTRULES.excluded)
+            ))
+        return None
+    if scopes == ['none']:
+        scopes = []
+    CONTEXTRULES.excluded = scopes
+    CONTEXTRULES.clear()
+    pref_set('xhighlights_exclude', ' '.join(scopes))
+    return set_excluded('')
+
+
+def set_pattern_scopes(cmdargs):
+    """ Show or set the scopes for a custom pattern (--scope).
+        Expects: 'index [scope...]', a scope of '*' means everywhere.
+    """
+    args = cmdargs.split()
+    custom = list(Codes.rules.custom)
+    try:
+        index = int(args[0])
+        patterninfo = custom[index]
+    except (IndexError, ValueError):
+        errmsg = 'Invalid index for custom pattern: {}'.format(cmdargs)
+        print_error(errmsg, boldtext=cmdargs)
+        return None
+    scopes = args[1:]
+    if scopes:
+        patterninfo = custom[index] = dict(
+            patterninfo,
+            scopes=() if scopes == ['*'] else tuple(scopes)
+        )
+        swap_rules(Codes.rules.replace(custom=custom))
+        save_user_patterns()
+    print_status('Custom pattern {} is used in: {}'.format(
+        patterninfo['patterntext'],
+        ' '.join(patterninfo['scopes']) or '*'
+    ))
+    return None
+
+
 def set_style(userstyle, stylename=None, silent=False):
     """ Sets the current style for 'link' or 'nick' """
 
@@ -989,16 +3347,13 @@ def set_style(userstyle, stylename=None, silent=False):
 
     stylecodes = get_stylecodes(userstyle)
 
-    if stylename == 'link':
-        Codes.link = stylecodes
-    elif stylename == 'nick':
-        Codes.nick = stylecodes
-    else:
+    if stylename not in ('link', 'nick'):
         print_error(
             'Invalid style name: {}'.format(stylename),
             boldtext=stylename
         )
         return False
+    swap_rules(Codes.rules.replace(**{stylename: stylecodes}))
 
     # Save preference.
     if not pref_set('xhighlights_{}'.format(stylename), userstyle):
@@ -1014,6 +3369,150 @@ def set_style(userstyle, stylename=None, silent=False):
     return True
 
 
+def start_profile(cmdargs):
+    """ Profile the next N message_filter() calls (--profile).
+        Expects: 'N'
+    """
+    global PROFILER
+    if PROFILER is not None:
+        print_error('Already profiling, {} of {} messages are done.'.format(
+            PROFILER.calls,
+            PROFILER.count
+        ))
+        return None
+    try:
+        count = int(cmdargs)
+    except ValueError:
+        count = 0
+    if count < 1:
+        errmsg = 'Invalid message count for --profile: {}'.format(cmdargs)
+        print_error(errmsg, boldtext=cmdargs)
+        return None
+    PROFILER = HookProfiler(count)
+    hook_message_filter(wrap=PROFILER.wrap)
+    print_status('Profiling the next {} messages.'.format(count))
+    return None
+
+
+def swap_rules(rules):
+    """ Make a new RuleSnapshot the active one, with a single assignment.
+        Anything still holding the old snapshot keeps a consistent view.
+        Rendered output for older versions can't be used anymore, so it
+        is dropped.
+    """
+    Codes.rules = rules
+    RENDERCACHE.clear()
+    return rules
+
+
+def tokenize_message(msg, nickmatcher=None, usernick=None, matcher=None):
+    """ Find everything to highlight in a message.
+        Links and emails are found with a single pass of find_links() over
+        the whole message, custom patterns are only tried on words that
+        could match them, and nicks are found by the NickMatcher.
+        Links and custom patterns cover a whole word, nicks only cover
+        the nick itself. Phrase patterns are found in the whole message
+        in one more pass, and win over anything they overlap.
+        Returns a sorted list of (start, end, kind, data), where kind is
+        one of 'custom', 'link', 'domain' (a link without a prefix),
+        'email', or 'nick'.
+        For 'custom' spans, data is (patterninfo, match, is_nick),
+        otherwise it is None.
+
+        Arguments:
+            msg         : The message to tokenize.
+            nickmatcher : NickMatcher to find nicks, or None for no nicks.
+            usernick    : The users own nick, which is never highlighted.
+            matcher     : CustomMatcher for custom patterns, defaults to
+                          Codes.rules.matcher.
+    """
+    wordspans = [m.span() for m in word_re.finditer(msg)]
+    if not wordspans:
+        return []
+    wordstarts = [start for start, _ in wordspans]
+
+    # Nicks, by word index.
+    nickspans = {}
+    if nickmatcher is not None:
+        for start, end in nickmatcher.find(msg, exclude=usernick):
+            i = bisect_right(wordstarts, start) - 1
+            nickspans.setdefault(i, []).append((start, end))
+
+    # Word index: (kind, data)
+    found = {}
+    # Custom patterns.
+    if matcher is None:
+        matcher = Codes.rules.matcher
+    for i in matcher.candidate_words(msg, wordstarts):
+        start, end = wordspans[i]
+        if end - start > MAX_WORD_LENGTH:
+            continue
+        patterninfo, rematch = matcher.match(msg[start:end])
+        if patterninfo is not None:
+            found[i] = ('custom', (patterninfo, rematch, i in nickspans))
+        if Watchdog.overbudget:
+            # Don't try the slow pattern on the rest of the message.
+            quarantine_slow_patterns()
+            break
+
+    # Links, the whole word is highlighted.
+    for linkmatch in find_links(msg):
+        i = bisect_right(wordstarts, linkmatch.start()) - 1
+        if i in found:
+            continue
+        start, end = wordspans[i]
+        if end - start <= MAX_WORD_LENGTH:
+            found[i] = (linkmatch.lastgroup, None)
+
+    spans = [
+        (wordspans[i][0], wordspans[i][1], kind, data)
+        for i, (kind, data) in found.items()
+    ]
+    for i, wordnicks in nickspans.items():
+        if i not in found:
+            spans.extend(
+                (start, end, 'nick', None) for start, end in wordnicks
+            )
+
+    # Phrases.
+    phrases = matcher.find_phrases(msg)
+    if Watchdog.overbudget:
+        quarantine_slow_patterns()
+    if phrases:
+        phrasestarts = [start for start, _, _, _ in phrases]
+        phraseends = [end for _, end, _, _ in phrases]
+
+        def in_phrase(span):
+            i = bisect_right(phrasestarts, span[1] - 1) - 1
+            return (i >= 0) and (phraseends[i] > span[0])
+
+        spans = [span for span in spans if not in_phrase(span)]
+        spans.extend(
+            (start, end, 'custom', (patterninfo, rematch, False))
+            for start, end, patterninfo, rematch in phrases
+        )
+    spans.sort()
+    return spans
+
+
+def timed_hook(func, hookstats):
+    """ Wrap a print hook function, so each call is recorded in a HookStats.
+        Calls made while emitting our own highlighted message are not
+        recorded (they are part of the outer call's time).
+    """
+    clock = time.perf_counter
+
+    def timed_hook_func(word, word_eol, userdata):
+        if EMITTING:
+            return func(word, word_eol, userdata)
+        start = clock()
+        result = func(word, word_eol, userdata)
+        hookstats.record(clock() - start, result)
+        return result
+
+    return timed_hook_func
+
+
 def try_stylecodes(styles):
     """ Trys to retrieve multiple style codes, and returns a string
         containing them.
@@ -1029,25 +3528,163 @@ def try_stylecodes(styles):
     return final
 
 
+def unload_plugin(userdata):
+    """ Plugin unload hook, stops the background log writer. """
+    _logger.stop()
+    return xchat.EAT_NONE
+
+
+def user_nick_event(word, word_eol, userdata):
+    """ The users own nick may have changed (Your Nick Changing, Connected,
+        or the server's welcome), forget the cached one for this server.
+    """
+    USERNICKS.pop(xchat.get_prefs('id'), None)
+    return xchat.EAT_NONE
+
+
+def with_case(chars):
+    """ Add upper and lower case versions of characters to a set,
+        so first_chars() doesn't have to care about (?i) flags.
+    """
+    if chars is None:
+        return None
+    return chars.union(
+        {c.lower() for c in chars},
+        {c.upper() for c in chars}
+    )
+
+
+def write_atomic(filename, text):
+    """ Write text to a file by writing a temp file in the same directory,
+        and renaming it over the original.
+        The original file's permissions are kept (the temp file is only
+        readable by the user), new files get the usual ones (umask).
+        Raises EnvironmentError on failure (the temp file is removed).
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except EnvironmentError:
+        # New file, like open() would create it.
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    dirname = os.path.dirname(filename) or '.'
+    fd, tmpname = tempfile.mkstemp(
+        prefix='.{}.'.format(os.path.basename(filename)),
+        suffix='.tmp',
+        dir=dirname
+    )
+    try:
+        with os.fdopen(fd, 'w') as fwrite:
+            fwrite.write(text)
+        os.chmod(tmpname, mode)
+        os.replace(tmpname, filename)
+    except EnvironmentError:
+        try:
+            os.remove(tmpname)
+        except EnvironmentError:
+            pass
+        raise
+
+
 # START OF SCRIPT
 # Load colors (must be loaded before class Codes()).
 COLORS = build_color_table()
+# Prefix/suffix codes for every color and style, see get_style().
+STYLES = build_style_table(COLORS)
+# Top-level domains for bare domain links, see find_links().
+TLDS = load_tlds(TLDFILE)
 
 
 class Codes(object):
     """ Holds current highlight styles. """
     defaultlink = color_code('u') + color_code('blue')
     defaultnick = color_code('green')
-    link = defaultlink
-    nick = defaultnick
     ownmsg = color_code('darkgrey')
     normal = color_code('reset')
-    custom = []
+    # Whether the matcher tries custom patterns with the most hits first.
+    reorder = False
+    # Whether CUSTOMFILE couldn't be loaded, and must not be overwritten.
+    rules_readonly = False
+    # Active rules (custom patterns and styles), see swap_rules().
+    rules = RuleSnapshot(
+        link=defaultlink,
+        nick=defaultnick,
+        matcher=CustomMatcher([])
+    )
+
+
+class Stats(object):
+    """ Counters for message_filter(). """
+    # Messages rejected by the pre-screen.
+    skipped = 0
+    # Messages that went through the whole filter.
+    processed = 0
+
+    @classmethod
+    def reset(cls):
+        """ Reset all counters. """
+        cls.skipped = 0
+        cls.processed = 0
+
+    @classmethod
+    def skipped_percent(cls):
+        """ Percentage of messages that were skipped. """
+        total = cls.skipped + cls.processed
+        if not total:
+            return 0.0
+        return (cls.skipped / total) * 100
+
+
+# Preferences from CONFIGFILE, see pref_get() and pref_set().
+PREFS = PrefStore(CONFIGFILE)
+PREFS.load()
+# Nick sets for each channel, used by message_filter().
+NICKS = NickIndex()
+# The users own nick for each server connection, see get_user_nick().
+USERNICKS = {}
+# Message rate monitors for each channel, used by message_filter().
+FLOODS = {}
+# Matcher with no custom patterns, for the 'links' flood mode.
+LINKS_ONLY = CustomMatcher([])
+# Effective rules for each channel, used by message_filter().
+CONTEXTRULES = ContextRules(
+    excluded=(pref_get('xhighlights_exclude') or '').split()
+)
+# Rendered output for repeated messages, used by message_filter().
+RENDERCACHE = RenderCache(maxsize=pref_get_int('xhighlights_cache_size', 512))
+# Log rotation policy.
+_logger.set_rotation(
+    pref_get_int('xhighlights_log_maxbytes', 2097152),
+    pref_get_int('xhighlights_log_backups', 3),
+    compress=(pref_get('xhighlights_log_compress') or '').lower() in (
+        '1', 'true', 'yes'
+    ),
+)
 
+# Flood detection, see FloodMonitor.
+FloodMonitor.threshold = pref_get_int('xhighlights_flood_rate', 30)
+FloodMonitor.floodmode = pref_get('xhighlights_flood_mode') or 'links'
+if FloodMonitor.floodmode not in ('links', 'pass'):
+    print_error(
+        'Invalid xhighlights_flood_mode (links or pass): {}'.format(
+            FloodMonitor.floodmode
+        ),
+        boldtext=FloodMonitor.floodmode
+    )
+    FloodMonitor.floodmode = 'links'
+# Time budget for custom patterns to match one word, in milliseconds.
+CustomMatcher.budget = pref_get_int('xhighlights_pattern_budget', 50) / 1000
+# Longer words are never highlighted as links or custom patterns.
+MAX_WORD_LENGTH = pref_get_int('xhighlights_max_word_length', 512)
+# Seconds between reordering custom patterns by hits (0 disables it).
+REORDER_INTERVAL = pref_get_int('xhighlights_reorder_interval', 0)
+Codes.reorder = REORDER_INTERVAL > 0
 
 # Load user preferences.
-for stylename in ('link', 'nick'):
-    load_user_color(stylename)
+with PREFS.batch():
+    for stylename in ('link', 'nick'):
+        load_user_color(stylename)
 load_user_patterns()
 
 
@@ -1056,6 +3693,7 @@ cmd_help = {
     'xhighlights': (
         'Usage: /XHIGHLIGHTS [-n [style] | -l [style]]\n'
         '       /XHIGHLIGHTS -a <pattern> <style> [template]\n'
+        '       /XHIGHLIGHTS -a -P <phrase pattern> <style> <template>\n'
         '       /XHIGHLIGHTS -r <index>\n'
         'Options:\n'
         '    -a p s t,--add p s t   : Add a custom pattern/word to\n'
@@ -1074,9 +3712,57 @@ cmd_help = {
         '    -l style,--link style  : Set link style by name/number.\n'
         '    -n style,--nick style  : Set nick style by name/number.\n'
         '    -p,--patterns          : Show current custom patterns.\n'
+        '    -P,--phrase            : With --add, add a phrase pattern.\n'
+        '                             It is matched against the whole\n'
+        '                             message, so it can have spaces.\n'
+        '                             The template is required.\n'
         '    -r num,--remove num    : Remove custom pattern by index.\n'
+        '    -R,--reset             : Reset stats (after printing them\n'
+        '                             if --stats is used too).\n'
+        '    -s,--stats             : Show hook latency stats, and other\n'
+        '                             counters.\n'
+        '    -S num [scope...],--scope num [scope...]\n'
+        '                           : Show/set where a custom pattern is\n'
+        '                             used. A scope of * means everywhere.\n'
+        '    -t num,--profile num   : Profile the next num messages, save\n'
+        '                             a pstats file next to the config\n'
+        '                             file, and show the slowest calls.\n'
+        '    -x [scope...],--exclude [scope...]\n'
+        '                           : Show/set where nothing is\n'
+        '                             highlighted. none clears them.\n'
         '\n    * style can be comma separated style names/numbers.\n'
-        '    * if no style is given, the current style will be shown.\n'),
+        '    * scope is network/channel, network, or #channel. Both\n'
+        '      can be globs, like: libera/#python* or */#bots.\n'
+        '    * if no style is given, the current style will be shown.\n'
+        '    * xhighlights_cache_size in the config file sets how many\n'
+        '      rendered messages are cached (0 disables it).\n'
+        '    * xhighlights_log_maxbytes and xhighlights_log_backups in the\n'
+        '      config file set when the log is rotated, and how many old\n'
+        '      logs are kept. xhighlights_log_compress = true gzips them.\n'
+        '    * xhighlights_reorder_interval in the config file sets how\n'
+        '      often (seconds) custom patterns are reordered so the ones\n'
+        '      with the most hits are tried first (0 disables it).\n'
+        '      Patterns that could match the same word are never\n'
+        '      reordered.\n'
+        '    * xhighlights_pattern_budget in the config file sets how\n'
+        '      many milliseconds a custom pattern may take for one word.\n'
+        '      Patterns are timed against tricky strings when they are\n'
+        '      added (or loaded from an older file), slow ones are\n'
+        '      refused. Patterns that are still slow while running are\n'
+        '      quarantined (remove and add them again to use them).\n'
+        '      xhighlights_max_word_length sets the longest word that can\n'
+        '      be a link or custom pattern.\n'
+        '    * xhighlights_events in the config file sets which events\n'
+        '      are highlighted (comma-separated). The default is all of:\n'
+        '      Channel Message, Channel Msg Hilight, Channel Action,\n'
+        '      Channel Action Hilight, Channel Notice, Your Message,\n'
+        '      Your Action, Private Message to Dialog, and\n'
+        '      Private Action to Dialog.\n'
+        '    * xhighlights_flood_rate in the config file sets how many\n'
+        '      lines per second a channel can have before it only gets\n'
+        '      links highlighted (0 disables it). Set\n'
+        '      xhighlights_flood_mode = pass to skip highlighting\n'
+        '      altogether during floods.\n'),
 }
 
 commands = {
@@ -1137,16 +3823,65 @@ for cmdname in commands.keys():
 # Hook into channel msgs
 _log.debug('Initial hook into channel messages...')
 event_hooks = {}
-for eventname in ('Channel Message', 'Channel Msg Hilight', 'Your Message'):
-    eventhookname = 'message_filter.{}'.format(
+# Word layout and stages for every print event message_filter() handles.
+# Nicks aren't highlighted in highlights (that's what the highlight is for)
+# or dialogs (there is only one other nick). Channel Notice has the channel
+# before the message.
+EVENT_PIPELINES = {
+    pipeline.event: pipeline
+    for pipeline in (
+        EventPipeline('Channel Action'),
+        EventPipeline('Channel Action Hilight', nicks=False),
+        EventPipeline('Channel Message'),
+        EventPipeline('Channel Msg Hilight', nicks=False),
+        EventPipeline('Channel Notice', msgindex=2),
+        EventPipeline('Private Action to Dialog', nicks=False),
+        EventPipeline('Private Message to Dialog', nicks=False),
+        EventPipeline('Your Action'),
+        EventPipeline('Your Message'),
+    )
+}
+# Known event names, by lower case name (see load_message_events()).
+EVENT_NAMES = {eventname.lower(): eventname for eventname in EVENT_PIPELINES}
+# Print events that message_filter() is hooked into.
+MESSAGE_EVENTS = load_message_events()
+# Latency stats for each message_filter() hook, by event name.
+HOOKSTATS = {}
+# Profiler for /xhighlights --profile, see start_profile().
+PROFILER = None
+hook_message_filter()
+
+# Hook into user list changes, to keep the nick index current.
+nickevents = (
+    'Join', 'Part', 'Part with Reason', 'Kick', 'Quit', 'Change Nick',
+    'You Join', 'You Part', 'You Part with Reason', 'You Kicked',
+)
+for eventname in nickevents:
+    eventhookname = 'nick_event.{}'.format(eventname.lower().replace(' ', ''))
+    event_hooks[eventhookname] = xchat.hook_print(
+        eventname,
+        nick_event,
+        userdata=eventname
+    )
+event_hooks['nick_names_end'] = xchat.hook_server('366', nick_names_end)
+# Hook into own nick changes, to keep the cached nick current.
+for eventname in ('Your Nick Changing', 'Connected'):
+    eventhookname = 'user_nick_event.{}'.format(
         eventname.lower().replace(' ', '')
     )
     event_hooks[eventhookname] = xchat.hook_print(
         eventname,
-        message_filter,
+        user_nick_event,
         userdata=eventname
     )
-    _log.debug('Initially hooked event: {}'.format(eventhookname))
+event_hooks['user_nick_welcome'] = xchat.hook_server('001', user_nick_event)
+if Codes.reorder:
+    event_hooks['reorder_timer'] = xchat.hook_timer(
+        REORDER_INTERVAL * 1000,
+        reorder_timer
+    )
+# Flush the log queue and stop its writer thread on unload.
+xchat.hook_unload(unload_plugin)
 
 
 # Print status
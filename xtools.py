@@ -546,6 +546,27 @@ def build_color_table():
     return colors
 
 
+def build_style_table(colors):
+    """ Builds a dict of {(colorname, bold, underline): (prefix, suffix)}
+        for every color name in colors, and returns it.
+        (see get_style())
+    """
+    boldcode = colors['bold']['code']
+    underlinecode = colors['underline']['code']
+    resetcode = colors['reset']['code']
+    styles = {}
+    for colorname, colorinfo in colors.items():
+        for bold in (False, True):
+            for underline in (False, True):
+                prefix = ''.join((
+                    boldcode if bold else '',
+                    underlinecode if underline else '',
+                    colorinfo['code'],
+                ))
+                styles[(colorname, bold, underline)] = (prefix, resetcode)
+    return styles
+
+
 def clear_catchers():
     """ Clears all catchers """
 
@@ -620,13 +641,27 @@ def color_code(color):
         return xtools.colors['reset']['code']
 
 
+def colorjoin(fragments, sep=''):
+    """ Colorize a list of fragments, and join them.
+        Each fragment is either a plain string (not colored), or a tuple
+        of colorstr() arguments: (color, text[, bold[, underline]]).
+    """
+    parts = []
+    for fragment in fragments:
+        if isinstance(fragment, str):
+            parts.append(fragment)
+            continue
+        prefix, suffix = get_style(*((fragment[0], ) + fragment[2:]))
+        parts.append(''.join((prefix, str(fragment[1]), suffix)))
+    return sep.join(parts)
+
+
 def colormulti(color=None, words=None, bold=False, underline=False):
     """ Same as colorstr, but it accepts a list of strings,
         and returns a list of colorized strings.
     """
-
-    return [colorstr(color=color, text=s, bold=bold, underline=underline)
-            for s in words]
+    prefix, suffix = get_style(color, bold=bold, underline=underline)
+    return [''.join((prefix, str(s), suffix)) for s in words]
 
 
 def colorstr(color=None, text=None, bold=False, underline=False):
@@ -640,20 +675,11 @@ def colorstr(color=None, text=None, bold=False, underline=False):
             underline  : Boolean. whether text is underlined or not.
     """
 
-    # normal color code
-    boldcode = ''
-    underlinecode = ''
-    normal = ''
-    code = color_code(color)
-    # initial text items (basic coloring)
-    strcodes = [code, str(text)]
-    # Handle extra formatting (bold, underline)
-    if underline:
-        strcodes.insert(0, underlinecode)
-    if bold:
-        strcodes.insert(0, boldcode)
-
-    return '{}{}'.format(''.join(strcodes), normal)
+    try:
+        prefix, suffix = xtools.styles[(color, bool(bold), bool(underline))]
+    except KeyError:
+        prefix, suffix = get_style(color, bold=bold, underline=underline)
+    return ''.join((prefix, str(text), suffix))
 
 
 def compile_re(restr):
@@ -903,6 +929,30 @@ def get_pref(opt):
     return None
 
 
+def get_style(color, bold=False, underline=False):
+    """ Returns (prefix, suffix) codes for a color and style, from
+        xtools.styles. Colors that aren't in the table yet (mIRC numbers)
+        are added.
+    """
+    key = (color, bool(bold), bool(underline))
+    try:
+        return xtools.styles[key]
+    except KeyError:
+        pass
+    resetcode = xtools.colors['reset']['code']
+    # Prints an error, and returns the reset code for bad colors.
+    code = color_code(color)
+    prefix = ''.join((
+        xtools.colors['bold']['code'] if bold else '',
+        xtools.colors['underline']['code'] if underline else '',
+        code,
+    ))
+    style = (prefix, resetcode)
+    if code != resetcode:
+        xtools.styles[key] = style
+    return style
+
+
 def get_window(tabtitle, focus=True):
     """ Open a tab, and wait for it to be available.
         Returns the tab's context (unless it times out, then None)
@@ -1548,22 +1598,26 @@ def print_saved_msg(msg, chanspace=16, nickspace=16,
         ..from xtools.ignored_msgs, or xtools.caught_msgs[msgid].
     """
 
-    msgtime = '({})'.format(colorstr('grey', msg['time']))
-    chan = '[{}]'.format(colorstr('green', msg['channel']))
-    # manually get channel spacing, instead of .ljust() including color codes
-    chan = '{}{}'.format(chan, (' ' * (chanspace - len(msg['channel']))))
     # strip color from nick, and add our own.
     nick = remove_mirc_color(msg['nick'])
     if 'action' in msg['type']:
-        nick = colorstr('darkblue', nick.ljust(nickspace))
         # user action, add a big * on it.
-        nick = '{}{}'.format(colorstr('red', '*', bold=True), nick)
+        nickfragments = [
+            ('red', '*', True),
+            ('darkblue', nick.ljust(nickspace)),
+        ]
     else:
         # normal channel msg
-        nick = colorstr('darkblue', nick.ljust(nickspace + 1))
+        nickfragments = [('darkblue', nick.ljust(nickspace + 1))]
 
     # Format long messages
-    msglabel = '{} {} {}: '.format(msgtime, chan, nick)
+    # (manually get channel spacing, .ljust() would include color codes)
+    msglabel = colorjoin([
+        '(', ('grey', msg['time']), ') ',
+        '[', ('green', msg['channel']), ']',
+        ' ' * (chanspace - len(msg['channel'])),
+        ' ',
+    ] + nickfragments + [': '])
     # Figure maximum width for label + msg, and for msg alone.
     # Making the max width of a message shorter than the usual chat window,
     # so maybe it will look good under normal circumstances.
@@ -1580,7 +1634,7 @@ def print_saved_msg(msg, chanspace=16, nickspace=16,
     # Wrap long lines with msglines() if needed, colorize highlighted msgs.
     if 'hilight' in msg['type']:
         # highlighted msg.
-        msgtext = '\n'.join(colorstr('red', s) for s in msglines(msg['msg']))
+        msgtext = '\n'.join(colormulti('red', msglines(msg['msg'])))
     else:
         # normal msg.
         msgtext = '\n'.join(msglines(msg['msg']))
@@ -1791,16 +1845,36 @@ def remove_ignored_nick(nickstr):
         return False
 
 
-def remove_mirc_color(text):
-    """ Removes color code from text
+# Helper for remove_mirc_color (for preloading sub function).
+# IRC formatting codes: color (\x03 with optional fg,bg), hex color
+# (\x04 with optional rrggbb,rrggbb), bold, hidden, reset, monospace,
+# reverse, italic, strikethrough, and underline.
+mirc_color_regex = (
+    r'\x03(?:\d{1,2}(?:,\d{1,2})?)?'
+    r'|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?'
+    r'|\x08<?'
+    r'|[\x02\x0f\x11\x16\x1d\x1e\x1f]'
+)
+mirc_sub_pattern = re.compile(mirc_color_regex).sub
+# Stripped short strings (like nicks), see remove_mirc_color().
+mirc_strip_cache = {}
+
+
+def remove_mirc_color(
+        text, _resubpat=mirc_sub_pattern, _cache=mirc_strip_cache,
+        _cachelen=32, _cachemax=4096):
+    """ Removes IRC formatting codes (colors and styles) from text,
+        with a single regex pass.
+        Short strings, like nicks, are memoized.
     """
-    badchars = ['{}<'.format(chr(8)), chr(8), chr(15)]
-    for badchar in badchars:
-        if badchar in text:
-            text = text.replace(badchar, '')
-
-    text = xchat.strip(text)
-    return text
+    if len(text) > _cachelen:
+        return _resubpat('', text)
+    stripped = _cache.get(text, None)
+    if stripped is None:
+        if len(_cache) >= _cachemax:
+            _cache.clear()
+        stripped = _cache[text] = _resubpat('', text)
+    return stripped
 
 
 def save_catchers():
@@ -2415,15 +2489,10 @@ def cmd_searchuser(word, word_eol, userdata=None):  # noqa
 
     # Print results.
     if results:
-        # Setup some default colors (formatting functions)
-        def colornick(n):
-            return colorstr(color='blue', text=n)
-
-        def colorhost(h):
-            return colorstr(color='darkpurple', text=h)
-
-        def colorchan(cs):
-            return colorstr(color='darkgreen', text=cs)
+        # Default colors for each part.
+        nickcolor = 'blue'
+        hostcolor = 'darkpurple'
+        chancolor = 'darkgreen'
 
         # Sort results for better printing..
         results = sorted(results, key=lambda u: u.nick)
@@ -2447,20 +2516,25 @@ def cmd_searchuser(word, word_eol, userdata=None):  # noqa
 
                 # Helper function for formatting.
                 def formatter(t):
-                    return '{} - ({})\n{}{}'.format(
-                        colornick(t[0]),
-                        colorhost(t[1]),
-                        (' ' * 8),
-                        colorchan(t[2]))
+                    return colorjoin([
+                        (nickcolor, t[0]),
+                        ' - (',
+                        (hostcolor, t[1]),
+                        ')\n' + (' ' * 8),
+                        (chancolor, t[2]),
+                    ])
 
                 # Format the new results.
                 resultsfmt = [formatter(i) for i in newresults]
             else:
                 # Current channel only, no host.
                 def formatter(u):
-                    return '{} - ({})'.format(
-                        colornick(u.nick),
-                        colorhost(u.host))
+                    return colorjoin([
+                        (nickcolor, u.nick),
+                        ' - (',
+                        (hostcolor, u.host),
+                        ')',
+                    ])
                 resultsfmt = [formatter(i) for i in results]
 
         # Don't include host with results string.
@@ -2477,16 +2551,17 @@ def cmd_searchuser(word, word_eol, userdata=None):  # noqa
 
                 # Basic format string for user : (channels, channels)
                 def formatter(t):
-                    return '{}\n{}{}'.format(
-                        colornick(t[0]),
-                        (' ' * 8),
-                        colorchan(t[1]))
+                    return colorjoin([
+                        (nickcolor, t[0]),
+                        '\n' + (' ' * 8),
+                        (chancolor, t[1]),
+                    ])
 
                 # Use the formatter to format results.
                 resultsfmt = [formatter(i) for i in newresults]
             else:
                 # Show nick only
-                resultsfmt = [colornick(n.nick) for n in results]
+                resultsfmt = colormulti(nickcolor, [n.nick for n in results])
 
         # Single line results or multi line...
         if len(results) < 5 and (not match_host) and (not argd['--all']):
@@ -2887,6 +2962,8 @@ cmd_aliases = {
 
 # Load Colors
 xtools.colors = build_color_table()
+# Prefix/suffix codes for every color and style, see get_style().
+xtools.styles = build_style_table(xtools.colors)
 
 # Load Preferences
 load_prefs()